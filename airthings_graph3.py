@@ -14,7 +14,12 @@ Last updated: 07/13/23
 
 import pandas as pd
 import os
+import matplotlib
+matplotlib.use('Agg')  # Non-interactive backend: every graph is written to disk, nothing blocks on a window.
 import matplotlib.pyplot as plt
+from matplotlib.patches import Patch
+from matplotlib.lines import Line2D
+import matplotlib.dates as mdates
 
 import requests
 import zipfile
@@ -23,6 +28,15 @@ import sys
 import re
 import pandas
 import logging
+import pickle
+import itertools
+import concurrent.futures
+import math
+import functools
+import inspect
+import types
+import hashlib
+import json
 from colorama import init, Fore, Style
 from datetime import datetime, timedelta
 import numpy as np
@@ -32,6 +46,71 @@ import seaborn as sns
 # Initialize colorama
 init()
 
+# Study periods in order, bounded by the visit dates in each participant's date_dict (same boundaries as the R code).
+PERIODS = ['Baseline', 'Intervention', 'Follow_Up']
+
+# First and last visit of each study period, in the order of PERIODS.
+PERIOD_VISITS = [('1', '2'), ('2B', '3'), ('3B', '4')]
+
+# Names of the combined entries (all participants, and all participants of each group) in the summary statistics.
+DATA_GROUPS = ['overall', 'group_A', 'group_B', 'group_C']
+
+# Visits that study-relative time is measured from: the start of the baseline, intervention, and follow-up periods.
+STUDY_TIME_ANCHORS = ['1', '2B', '3B']
+
+# Period comparisons of the effect table as (period, reference period); each is reported as period - reference.
+EFFECT_CONTRASTS = [('Intervention', 'Baseline'), ('Follow_Up', 'Baseline'), ('Follow_Up', 'Intervention')]
+
+# Bootstrap replicates drawn per chunk (one seed and one worker task per chunk) in the effect table.
+BOOTSTRAP_CHUNK = 250
+
+# Most points drawn per line in the per-participant timeseries graphs (min and max of max_points / 2 time buckets).
+TIMESERIES_POINT_BUDGET = 2000
+
+# Version of the graph styling; bump it to re-render every graph after a change the render fingerprints cannot see
+# (e.g. a matplotlib or seaborn upgrade).
+RENDER_STYLE_VERSION = 1
+
+# Stylesheet shared by every participant's report-back document.
+REPORT_STYLE = """body { font-family: Helvetica, Arial, sans-serif; margin: 2em auto; max-width: 60em; color: #222; }
+h1, h2 { margin-bottom: 0.3em; }
+table { border-collapse: collapse; margin: 0.5em 0 1.5em 0; }
+th, td { border: 1px solid #ccc; padding: 0.25em 0.6em; text-align: right; }
+img { max-width: 100%; }
+"""
+
+# Weekday labels of the diurnal profiles, in the order of pandas' weekday numbers (Monday = 0).
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+# Exceedance thresholds for each variable as (label, direction, threshold). '>' reports the percentage of hours above
+# the threshold and '<' the percentage of hours below it. PM2.5 in ug/m3 (EPA annual and 24-hour standards), CO2 in
+# ppm, VOC in ppb (Airthings guidance), humidity in %RH (comfort band). Rolling metrics (see ROLLING_METRICS) have
+# their own thresholds, e.g. the EPA 24-hour PM2.5 standard of 35.
+EXCEEDANCE_THRESHOLDS = {
+    'pm25': [('Percent above 12', '>', 12), ('Percent above 35', '>', 35)],
+    'co2': [('Percent above 800', '>', 800), ('Percent above 1000', '>', 1000), ('Percent above 1500', '>', 1500)],
+    'voc': [('Percent above 250', '>', 250), ('Percent above 2000', '>', 2000)],
+    'humidity': [('Percent below 30', '<', 30), ('Percent above 60', '>', 60)],
+    'pm25_24h': [('Percent above 35', '>', 35)],
+    'co2_8h': [('Percent above 1000', '>', 1000)],
+}
+
+# Rolling-window metrics added to the cohort table as name : (variable, window hours, minimum hours of data). A window
+# with fewer hours of data than the minimum is NaN (75% completeness, as for the EPA 24-hour and 8-hour averages).
+ROLLING_METRICS = {
+    'pm25_24h': ('pm25', 24, 18),
+    'co2_8h': ('co2', 8, 6),
+}
+
+# Longest time a single hourly sample can represent in the time-weighted statistics; a sample followed by a longer gap
+# only counts for this long.
+MAX_SAMPLE_INTERVAL = pd.Timedelta(hours=3)
+
+# Relative accuracy of the quantile sketches used for the combined entries, and the range of magnitudes it holds over.
+SKETCH_ALPHA = 0.01
+SKETCH_MIN_VALUE = 1e-2
+SKETCH_MAX_VALUE = 1e5
+
 class ColoredFormatter(logging.Formatter):
     COLORS = {
         'DEBUG': Style.DIM + Fore.BLUE,
@@ -61,11 +140,11 @@ def main():
     # Create a list of all unique participant IDs in order.
     part_id_list, data_log_df, part_id_dict = create_part_id_list(data_log_loc)
 
-    # Initialize dictionary to store the participant IDs as keys, their date_dict, group_assignment, and data.
-    participant_data = {}
+    # Initialize lists to hold each participant's data frame and metadata record (date_dict, GroupNO, airthings_id).
+    participant_frames = []
+    participant_records = []
 
-    # Cycle through all the participants, filling the participant_data dictionary with the groupNO, date dict, airthings
-    # device ID, and airthings data.
+    # Cycle through all the participants, collecting the groupNO, date dict, airthings device ID, and airthings data.
     for part_id in part_id_list:
 
         date_dict, GroupNO, airthings_id = pull_group_and_dates(data_log_df, part_id_dict, part_id)
@@ -86,17 +165,25 @@ def main():
         # Pull the airthings data for the requested participant for the requested time frame.
         data_df = pull_airthings_data(part_id, access_token, airthings_id, SN_dict, date_dict, logger)
 
-        # Fill participant_data dictionary with all the info from the participant.
-        participant_data = fill_participant_data(participant_data, part_id, date_dict, GroupNO, airthings_id, data_df)
+        # Add the participant's data and metadata to the lists used to build the cohort table.
+        fill_participant_data(participant_frames, participant_records, part_id, date_dict, GroupNO, airthings_id,
+                              data_df)
 
-    # Define the pastel color palette
-    colors = sns.color_palette('pastel')[1:5]
-    # Define legend elements
-    legend_elements = [plt.bar(0, 0, color=color, label=label) for label, color in
-                       zip(['Group A', 'Group B', 'Group C', 'Overall'], colors)]
+    # Combine all participants into one long-format cohort table (participant, group, period, time, sensor columns)
+    # with the participant metadata held in a side table.
+    cohort_df, participant_meta = build_cohort_table(participant_frames, participant_records)
+
+    # Add the hours since visit 1 and since the start of the intervention and follow-up periods to every row.
+    cohort_df = add_study_time(cohort_df, participant_meta)
+
+    # Assign each participant a color based on the GroupNO.
+    participant_meta = assign_color(participant_meta)
+
+    # Legend elements of the group colors (free-standing patches, so they can be sent to the render workers)
+    legend_elements = list(group_legend_elements())
 
     #Create 3 lists, containing all participant IDs for participants of each educational group.
-    educational_groups = group_lists(participant_data)
+    educational_groups = group_lists(participant_meta)
 
     # Location to save graphs.
     graph_location = "/Users/maddiewallace/PycharmProjects/AIREanalysis/graph_outputs"
@@ -105,18 +192,121 @@ def main():
     # Choices: 'co2', 'humidity', 'light', 'pressure', 'sla', 'temp', 'voc', 'pm1', or 'pm25'
     environ_var_list = ['temp']
 
-    # Calculate the summary statistics and create graphs for the desired environmental variables.
-    for environ_var in environ_var_list:
-        # Calculate pm25 summary stats (percentiles, max, mean, % above 12) for each participant individually, for all
-        # participants combined, and for each group (A, B, C) combined. Add them to participant_data under the key
-        # 'summary_stats'.
-        participant_data, data_groups = prep_summary_stats(participant_data, environ_var, environ_var_list)
-
-        graph_group_timeseries(participant_data, educational_groups, data_groups.keys(), environ_var, graph_location)
-        plot_summaries(participant_data, legend_elements, environ_var, graph_location)
-        # plot_box_whisker(participant_data, legend_elements, environ_var, graph_location)
-
-    # print(participant_data)
+    # Report how many of the expected hours each participant has in each period, duplicate timestamps, sensor NaN
+    # rates, and every run of missing hours.
+    completeness_table, missing_runs = calculate_completeness(cohort_df, participant_meta)
+    save_table(completeness_table, graph_location, 'data_completeness.csv')
+    save_table(missing_runs, graph_location, 'missing_hours.csv')
+
+    # Add the rolling-window metrics (24-hour PM2.5, 8-hour CO2) to the cohort table. Stats and exceedances are
+    # calculated for them alongside the variables they come from.
+    cohort_df = add_rolling_metrics(cohort_df)
+    stats_var_list = environ_var_list + [metric for metric, (environ_var, _, _) in ROLLING_METRICS.items() if
+                                         environ_var in environ_var_list]
+
+    # Set to True to update the saved summary stats with only the hours synced since the last run, or False (default)
+    # to recalculate the participant stats exactly from all hours. The percentiles of the combined entries (overall and
+    # groups) always come from merged quantile sketches, within about 1% of a sample near the percentile's rank. True
+    # also makes the participant percentiles sketch-based; as they are not interpolated like np.percentile, with a few
+    # hundred hours per period they can differ from the exact percentiles by several percent (up to about 7% for the
+    # 10th).
+    incremental_stats = False
+    state_path = os.path.join(graph_location, 'summary_stats_state.pkl')
+
+    # Calculate summary stats (percentiles, max, mean, % above thresholds) for each participant individually, for all
+    # participants combined, and for each group (A, B, C) combined, for every variable and period in one pass.
+    if incremental_stats:
+        stats_state = update_stats_state(load_stats_state(state_path), cohort_df, participant_meta, stats_var_list)
+        save_stats_state(stats_state, state_path)
+        summary_table = summary_table_from_state(stats_state, participant_meta)
+    else:
+        summary_table = prep_summary_stats(cohort_df, stats_var_list)
+    save_table(summary_table, graph_location, 'summary_stats.csv')
+    save_table(calculate_daily_maxima(cohort_df, stats_var_list), graph_location, 'daily_maxima.csv')
+
+    # Set to True to also calculate time-weighted stats (each hour weighted by the time it represents, so that periods
+    # with dense data do not dominate) along with the longest data gap and coverage of each participant and period.
+    time_weighted_stats = True
+    if time_weighted_stats:
+        weighted_table = calculate_time_weighted_stats(cohort_df, participant_meta, stats_var_list)
+        save_table(weighted_table, graph_location, 'time_weighted_stats.csv')
+
+    # Change in each variable's mean between periods for every participant, all participants, and each group, and the
+    # differences between groups, with seeded bootstrap confidence intervals (workers spreads them over processes).
+    effect_table = calculate_effect_table(summary_table, participant_meta, environ_var_list, workers=None)
+    save_table(effect_table, graph_location, 'effect_table.csv')
+
+    # Fit the period x group model of every variable in this process (previously done by pasting into the R script).
+    model_table = fit_period_group_model(cohort_df, environ_var_list)
+    save_table(model_table, graph_location, 'period_group_model.csv')
+
+    # Find every run of consecutive hours beyond each threshold, and summarize their count, duration, and peak.
+    episodes = detect_exceedance_episodes(cohort_df, stats_var_list)
+    save_table(episodes, graph_location, 'exceedance_episodes.csv')
+    save_table(summarize_episodes(episodes), graph_location, 'exceedance_episode_summary.csv')
+
+    # Put every participant on one shared hourly grid, then save each combined entry's hourly mean and envelope and
+    # the correlations between participants.
+    part_groups = participant_meta['GroupNO']
+    grid_hours, aligned = align_to_hour_grid(cohort_df, environ_var_list, list(participant_meta.index))
+    group_series = group_aligned_series(aligned, part_groups)
+    for i, environ_var in enumerate(environ_var_list):
+        group_table = pd.concat({stat: pd.DataFrame(series[i].T, index=grid_hours, columns=DATA_GROUPS)
+                                 for stat, series in group_series.items()}, axis=1)
+        save_table(group_table, graph_location, f'{environ_var}_group_hourly.csv')
+        save_table(pd.DataFrame(pairwise_correlations(aligned[i]), index=participant_meta.index,
+                                columns=participant_meta.index), graph_location, f'{environ_var}_correlations.csv')
+
+    # The same group series on a study-relative grid, hours since the start of the intervention (visit 2B), so that
+    # the trajectories around the intervention line up across participants.
+    relative_hours, relative_aligned = align_to_hour_grid(cohort_df, environ_var_list, list(participant_meta.index),
+                                                          anchor='2B')
+    relative_series = group_aligned_series(relative_aligned, part_groups)
+    for i, environ_var in enumerate(environ_var_list):
+        relative_table = pd.concat({stat: pd.DataFrame(series[i].T, index=relative_hours, columns=DATA_GROUPS)
+                                    for stat, series in relative_series.items()}, axis=1)
+        save_table(relative_table, graph_location, f'{environ_var}_group_since_intervention.csv')
+
+    # Hour-of-day x weekday profiles of every variable, recalculated only when the cohort data has changed.
+    profile_table = load_diurnal_profiles(cohort_df, participant_meta, environ_var_list,
+                                          os.path.join(graph_location, 'diurnal_profiles.pkl'))
+    save_table(profile_table, graph_location, 'diurnal_profiles.csv')
+
+    # Write an offline dashboard of every participant and combined entry (series averaged over dashboard_rollup_hours,
+    # summary stats, and profiles), so results can be explored without running this script again.
+    dashboard_rollup_hours = 6
+    rollup_times, rollup = bucket_aligned(grid_hours, aligned, dashboard_rollup_hours)
+    dashboard_data = build_dashboard_data(participant_meta, summary_table, profile_table, rollup_times, rollup,
+                                          environ_var_list, dashboard_rollup_hours)
+    write_dashboard(dashboard_data, graph_location)
+
+    # Set to True to graph each group's timeseries as a median line with percentile bands across participants (per
+    # envelope_bucket_hours bucket), or False to graph one line per participant.
+    envelope_mode = True
+    envelope_bucket_hours = 24
+    bucket_times, bucketed = bucket_aligned(grid_hours, aligned, envelope_bucket_hours)
+    envelope_series = group_aligned_series(bucketed, part_groups)
+
+    group_envelopes = {environ_var: (bucket_times, {stat: series[i] for stat, series in envelope_series.items()})
+                       for i, environ_var in enumerate(environ_var_list)} if envelope_mode else None
+
+    # Create graphs for the desired environmental variables from the whole-collection summary stats. Every graph is an
+    # independent job with its own precomputed data, spread over render_workers processes (None renders in order here).
+    # Set summary_grid to True to graph the max, mean, and exceedances of every variable in one small-multiples
+    # figure, or False for one bar chart per variable and statistic.
+    render_workers = os.cpu_count()
+    summary_grid = True
+    render_jobs = build_render_jobs(cohort_df, participant_meta, summary_table, profile_table, group_envelopes,
+                                    educational_groups, legend_elements, environ_var_list, graph_location,
+                                    summary_grid)
+    render_charts(render_jobs, render_workers, os.path.join(graph_location, 'render_manifest.json'))
+
+    # Build the report-back document of every participant (their stats, period changes, and graphs next to their group
+    # and all participants), spread over the same worker processes.
+    report_location = os.path.join(graph_location, 'reports')
+    shared_assets, report_jobs = build_report_jobs(cohort_df, participant_meta, summary_table, effect_table,
+                                                   legend_elements, environ_var_list, report_location)
+    generate_participant_reports(report_jobs, shared_assets, report_location, render_workers)
 
     return
 
@@ -489,379 +679,3004 @@ def pull_airthings_data(part_id, access_token, airthings_id, SN_dict, date_dict,
 
     return data_df
 
-def fill_participant_data(participant_data, part_id, date_dict, GroupNO, airthings_id, data_df):
-    """Fills the participant_data dictionary with all the info for the current participant.
+def fill_participant_data(participant_frames, participant_records, part_id, date_dict, GroupNO, airthings_id, data_df):
+    """Adds the data and metadata for the current participant to the lists used to build the cohort table.
 
     Args:
-        participant_data (dict) : nested dictionary updated to contain participant IDs as keys, their date_dict, and
-        group_assignment.
+        participant_frames (list) : list of participant data frames, each with a 'part_id' column.
+        participant_records (list) : list of participant metadata dicts (part_id, GroupNO, airthings_id, visit dates).
+        part_id (str) : participant ID
         date_dict (dict) : dictionary of visit dates with visit number as the keys and the date as the value.
         GroupNO (str) : educational group assignment of the given participant (A, B, or C).
         airthings_id (str) : the airthings SpacePro ID for the given participant.
-        part_id (str) : participant ID
         data_df (df) : dataframe of all the data from the given participant
 
     returns:
-        participant_data (dict) : nested dictionary updated to contain participant IDs as keys, their date_dict, and
-        group_assignment.
+        participant_frames (list) : list of participant data frames, now including the current participant.
+        participant_records (list) : list of participant metadata dicts, now including the current participant.
     """
 
-    data_df = data_df.dropna()
+    # Only drop rows without any sensor values, so that missing values of single sensors show up in the completeness
+    # report (the stats skip missing values).
+    data_df = data_df.dropna(how='all', subset=[col for col in data_df.columns if col != 'time'])
 
-    # Add the part_id as a key in the participant_data dict with a nested info.
-    participant_data[part_id] = {
-        'date_dict': date_dict,
-        'GroupNO': GroupNO,
-        'airthings_id': airthings_id,
-        'data': data_df,
-    }
+    # Tag every row with the participant ID so the frames can be stacked into one table.
+    participant_frames.append(data_df.assign(part_id=part_id))
+
+    # The metadata record holds one column per visit date, keyed by the visit number.
+    participant_records.append({'part_id': part_id, 'GroupNO': GroupNO, 'airthings_id': airthings_id, **date_dict})
+
+    return participant_frames, participant_records
 
-    return participant_data
+def build_cohort_table(participant_frames, participant_records):
+    """Stacks all participants into one long-format cohort table with a row per participant per timestamp and a column
+    per sensor variable. Participant metadata is kept in a separate side table indexed by participant ID.
 
-def assign_color(participant_data, part_id):
-    """Adds a color code based on the GroupNO of the participant.
     Args:
-        participant_data (dict) : nested dictionary containing participant IDs as keys, their date_dict, and
-        group_assignment.
-        part_id (str) : participant ID
-        GroupNO (str) : educational group assignment of the given participant (A, B, or C).
+        participant_frames (list) : list of participant data frames, each with a 'part_id' column.
+        participant_records (list) : list of participant metadata dicts (part_id, GroupNO, airthings_id, visit dates).
+
+    Returns:
+        cohort_df (df) : cohort table with 'part_id', 'GroupNO', 'period', and 'time' columns followed by one column per
+        sensor variable, sorted by participant and time.
+        participant_meta (df) : participant metadata indexed by 'part_id' with 'GroupNO', 'airthings_id', and one
+        column per visit date.
+    """
+
+    participant_meta = pd.DataFrame.from_records(participant_records).set_index('part_id').sort_index()
+
+    cohort_df = pd.concat(participant_frames, ignore_index=True)
+    sensor_cols = [col for col in cohort_df.columns if col not in ('part_id', 'time')]
+
+    # Attach the group assignment to every row and label each row with its study period.
+    cohort_df['GroupNO'] = cohort_df['part_id'].map(participant_meta['GroupNO'])
+    cohort_df['period'] = assign_period(cohort_df, participant_meta)
+
+    cohort_df = cohort_df[['part_id', 'GroupNO', 'period', 'time'] + sensor_cols]
+    cohort_df = cohort_df.sort_values(['part_id', 'time'], ignore_index=True)
+
+    return cohort_df, participant_meta
+
+def assign_period(cohort_df, participant_meta):
+    """Labels each row of the cohort table with its study period (Baseline, Intervention, or Follow_Up) using the visit
+    dates of the row's participant. Rows outside of all periods are left as NaN.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id' and 'time' columns.
+        participant_meta (df) : participant metadata indexed by 'part_id' with one column per visit date.
+
+    Returns:
+        period (Categorical) : the study period of each row of cohort_df.
+    """
+
+    # Look up each row's visit dates and compare them to the row's timestamp all at once.
+    visits = participant_meta.loc[cohort_df['part_id'], ['1', '2', '2B', '3', '3B', '4']].to_numpy('datetime64[ns]')
+    time = cohort_df['time'].to_numpy('datetime64[ns]')
+
+    conditions = [
+        (time >= visits[:, 0]) & (time <= visits[:, 1]),
+        (time >= visits[:, 2]) & (time <= visits[:, 3]),
+        (time >= visits[:, 4]) & (time <= visits[:, 5]),
+    ]
+    period = np.select(conditions, PERIODS, default=None)
+
+    return pd.Categorical(period, categories=PERIODS, ordered=True)
+
+def add_study_time(cohort_df, participant_meta, anchors=STUDY_TIME_ANCHORS):
+    """Adds study-relative time columns to the cohort table: the hours since each anchor visit of the row's own
+    participant (negative before the visit), looked up for every row at once.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id' and 'time' columns.
+        participant_meta (df) : participant metadata indexed by 'part_id' with one column per visit date.
+        anchors (list) : visits to measure time from, see STUDY_TIME_ANCHORS.
+
+    Returns:
+        cohort_df (df) : the cohort table with an 'hours_since_{visit}' column added for each anchor visit.
+    """
+
+    visits = participant_meta.loc[cohort_df['part_id'], anchors].to_numpy('datetime64[ns]')
+    time = cohort_df['time'].to_numpy('datetime64[ns]')
+    hours_since = (time[:, None] - visits) / np.timedelta64(1, 'h')
+
+    cohort_df = cohort_df.assign(**{f'hours_since_{visit}': hours_since[:, i] for i, visit in enumerate(anchors)})
+
+    return cohort_df
+
+def assign_color(participant_meta):
+    """Adds a color code based on the GroupNO of each participant.
+    Args:
+        participant_meta (df) : participant metadata indexed by 'part_id' with a 'GroupNO' column.
+
+    Returns:
+        participant_meta (df) : participant metadata, now containing a 'color' column.
+    """
+
+    # Assign colors based on 'GroupNO' value, anything outside of groups A, B, and C gets the overall color.
+    colors = group_colors()
+    participant_meta['color'] = [colors.get(group, colors['Overall']) for group in participant_meta['GroupNO']]
+
+    return participant_meta
+
+# The style registry: palettes and legend elements are built on first use and then shared by every graph drawn in the
+# process (the main process and each render worker), rather than being rebuilt per graph.
+
+@functools.lru_cache(maxsize=None)
+def group_colors():
+    """Returns the color of each group and of the combined entries, from the pastel palette.
 
     Returns:
-        participant_data (dict) : nested dictionary containing participant IDs as keys, their date_dict, and
-        group_assignment. Now containing color assignment.
+        colors (dict) : 'A', 'B', 'C', and 'Overall' : RGB tuple.
     """
 
-    # Define the pastel color palette
     colors = sns.color_palette('pastel')[1:5]
 
-    GroupNO = participant_data[part_id]['GroupNO']
+    return dict(zip(['A', 'B', 'C', 'Overall'], colors))
 
-    # Assign colors based on 'GroupNO' value
-    if GroupNO == 'A':
-        color = colors[0]
-    elif GroupNO == 'B':
-        color = colors[1]
-    elif GroupNO == 'C':
-        color = colors[2]
-    else:
-        color = colors[3]
+@functools.lru_cache(maxsize=None)
+def group_legend_elements():
+    """Returns the legend elements of the group colors, proxy patches that are not drawn in any figure.
+
+    Returns:
+        legend_elements (tuple) : one Patch per group and one for the combined entries.
+    """
+
+    return tuple(Patch(facecolor=color, label=label) for label, color in
+                 zip(['Group A', 'Group B', 'Group C', 'Overall'], group_colors().values()))
+
+@functools.lru_cache(maxsize=None)
+def participant_line_style(i):
+    """Returns the line style of the i-th participant of a graph with one line per participant, cycling through
+    colors, line styles, and markers so that neighbouring lines differ.
+
+    Args:
+        i (int) : position of the participant in the graph.
+
+    Returns:
+        line_style (dict) : 'color', 'linestyle', and 'marker' keyword arguments of plot.
+    """
 
-    participant_data[part_id]['color'] = color
+    colors = sns.color_palette('pastel')
+    line_styles = ['-', '--', '-.', ':']
+    markers = ['.', 'o', 'v', '^', 's', 'd']
 
-    return participant_data
+    return {'color': colors[i % len(colors)], 'linestyle': line_styles[i % len(line_styles)],
+            'marker': markers[i % len(markers)]}
 
-def prep_summary_stats(participant_data, environ_var, environ_var_list):
-    """ Preps for summary statistic (percentiles, max, mean, % above 12) calculations for environ_var. Calculations for
-    each participant, all participants combined, and all participants of each group (A, B, C) combined.
+def sensor_columns(cohort_df):
+    """Lists the sensor columns of the cohort table, leaving out the columns derived from them (study time, rolling
+    metrics).
 
     Args:
-        participant_data (dict) : nested dictionary updated to contain participant IDs as keys, their date_dict, and
-        group_assignment.
-        environ_var (str) : the name of the environmental variable that we are currently looking at/calculating stats for.
+        cohort_df (df) : cohort table with 'part_id', 'GroupNO', 'period', and 'time' columns followed by one column
+        per sensor variable.
 
     Returns:
-        participant_data (dict) : nested dictionary updated to contain participant IDs as keys, their date_dict, and
-        group_assignment. Now contains a nested summary statistics dictionary.
-        data_groups (dict) : metadata for all participants combined, group A combined, group B combined, and group C
-        combined.
+        sensor_cols (list) : names of the sensor columns, in table order.
+    """
 
-    Raises:
-        KeyError: If the "data" key is not present in participant_data or if the environ_var column is not present in the
-        DataFrame.
+    derived_cols = [f'hours_since_{visit}' for visit in STUDY_TIME_ANCHORS] + list(ROLLING_METRICS)
+    sensor_cols = [col for col in cohort_df.columns[cohort_df.columns.get_loc('time') + 1:] if col not in derived_cols]
+
+    return sensor_cols
+
+def expected_hour_grid(participant_meta):
+    """Lays out the expected hourly timestamps of every participant and period, from the first whole hour after the
+    start of the period to the last whole hour before its end, as flat arrays.
+
+    Args:
+        participant_meta (df) : participant metadata indexed by 'part_id' with one column per visit date.
+
+    Returns:
+        grid_part (array) : participant code (position in participant_meta) of every expected hour.
+        grid_period (array) : period code (position in PERIODS) of every expected hour.
+        grid_hour (array) : every expected hour, as whole hours since the epoch.
     """
 
-    # initialize a dict of lists to combine data from all participants, and from all participants of each group.
-    data_groups = {
-    'overall': [],
-    'group_A': [],
-    'group_B': [],
-    'group_C': []
-    }
+    visits = participant_meta[['1', '2', '2B', '3', '3B', '4']].to_numpy('datetime64[ns]')
+    visit_hours = (visits - np.datetime64(0, 'h')) / np.timedelta64(1, 'h')
+    first_hour = np.ceil(visit_hours[:, 0::2]).astype(int).T.ravel()
+    last_hour = np.floor(visit_hours[:, 1::2]).astype(int).T.ravel()
 
-    # Go through each individual participant, grab the data column, drop nan, and place it into the data_groups.
-    for part_id in participant_data.keys():
+    # One contiguous range per (period, participant), built with a single repeat instead of a loop of aranges.
+    lengths = np.maximum(last_hour - first_hour + 1, 0)
+    range_start = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    grid_hour = np.repeat(first_hour, lengths) + np.arange(lengths.sum()) - range_start
+    grid_period, grid_part = np.unravel_index(np.repeat(np.arange(len(lengths)), lengths),
+                                              (len(PERIODS), len(participant_meta)))
 
-        # If one of the combined groups, do not proceed as it will not contain the requested data key.
-        if part_id in data_groups.keys():
-            break
+    return grid_part, grid_period, grid_hour
+
+def match_hour_grid(cohort_df, participant_meta):
+    """Matches the rows of the cohort table with the expected hourly grid (see expected_hour_grid), keying every
+    expected hour and every row by (period, participant, hour) so that one set operation finds the observed hours.
+    Shared by the completeness report and the coverage of the gap metadata, so that both count hours the same way.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'period', and 'time' columns.
+        participant_meta (df) : participant metadata indexed by 'part_id' with one column per visit date.
+
+    Returns:
+        grid_key (array) : key of every expected hour; grid_key // hour_span is its flat (period, participant) index.
+        hour_span (int) : number of hours in a key, see grid_key.
+        observed (array) : boolean, True for the expected hours with at least one row.
+        unique_keys (array) : keys of the hours with rows (in a period), sorted.
+        key_counts (array) : number of rows in each of unique_keys.
+        group_key (array) : flat (period, participant) index of every row in a period.
+        in_period (array) : boolean, True for the rows of cohort_df in a period.
+    """
+
+    part_ids = list(participant_meta.index)
+    shape = (len(PERIODS), len(part_ids))
+
+    grid_part, grid_period, grid_hour = expected_hour_grid(participant_meta)
+    hour_span = grid_hour.max(initial=0) + 1
+    grid_key = np.ravel_multi_index((grid_period, grid_part), shape) * hour_span + grid_hour
+
+    # The hour of every row of the cohort table that falls in a period, keyed the same way as the grid.
+    in_period = cohort_df['period'].notna().to_numpy()
+    part_code = pd.Categorical(cohort_df['part_id'], categories=part_ids).codes[in_period]
+    period_code = cohort_df['period'].cat.codes.to_numpy()[in_period]
+    row_time = cohort_df['time'].to_numpy('datetime64[ns]')[in_period]
+    row_hour = (row_time - np.datetime64(0, 'h')) // np.timedelta64(1, 'h')
+    group_key = np.ravel_multi_index((period_code, part_code), shape)
+    row_key = group_key * hour_span + row_hour
+    unique_keys, key_counts = np.unique(row_key, return_counts=True)
+
+    observed = np.isin(grid_key, unique_keys, assume_unique=True)
+
+    return grid_key, hour_span, observed, unique_keys, key_counts, group_key, in_period
 
-        data = participant_data[part_id]["data"]
+def calculate_completeness(cohort_df, participant_meta):
+    """Compares the hours each participant actually has with the expected hourly grid of each study period (see
+    expected_hour_grid), with set operations over the whole cohort at once. Reports the missing hours, hours with
+    duplicate timestamps, and the rate of missing values (NaN) of each sensor column, for every participant and for the
+    combined entries (all participants, and all participants of each group), by period and for the whole collection.
 
-        # Check if "data" key exists and is a DataFrame
-        if not isinstance(data, pd.DataFrame):
-            raise KeyError("'data' key must contain a DataFrame.")
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'period', and 'time' columns followed by one column per sensor
+        variable.
+        participant_meta (df) : participant metadata indexed by 'part_id' with 'GroupNO' and one column per visit date.
+
+    Returns:
+        completeness_table (df) : completeness indexed by ('period', 'entity') with 'expected_hours', 'observed_hours',
+        'missing_hours', 'duplicate_hours', 'Completeness (%)', and one 'NaN rate {sensor} (%)' column per sensor.
+        Periods are PERIODS followed by 'All', entities are each participant followed by each entry of DATA_GROUPS.
+        missing_runs (df) : one row per run of consecutive missing hours with 'part_id', 'period', 'start', 'end', and
+        'hours'.
+    """
+
+    part_ids = list(participant_meta.index)
+    shape = (len(PERIODS), len(part_ids))
+    sensor_cols = sensor_columns(cohort_df)
+
+    grid_key, hour_span, observed, unique_keys, key_counts, group_key, in_period = match_hour_grid(cohort_df,
+                                                                                                   participant_meta)
+
+    # Expected hours with at least one row, and hours with more than one row.
+    counts = {
+        'expected_hours': np.bincount(grid_key // hour_span, minlength=np.prod(shape)),
+        'observed_hours': np.bincount(grid_key // hour_span, weights=observed, minlength=np.prod(shape)),
+        'duplicate_hours': np.bincount(unique_keys // hour_span, weights=key_counts > 1, minlength=np.prod(shape)),
+        'rows': np.bincount(group_key, minlength=np.prod(shape)),
+    }
+    nan_counts = {sensor: np.bincount(group_key, weights=cohort_df[sensor].isna().to_numpy()[in_period],
+                                      minlength=np.prod(shape)) for sensor in sensor_cols}
+
+    # Add 'All' over the periods and the combined entries over the participants; every count is a plain sum.
+    membership = combined_membership(participant_meta['GroupNO']).T.astype(int)
+    for count_dict in (counts, nan_counts):
+        for name, count in count_dict.items():
+            count = count.reshape(shape)
+            count = np.vstack([count, count.sum(axis=0)])
+            count_dict[name] = np.hstack([count, count @ membership]).ravel()
+
+    index = pd.MultiIndex.from_product([PERIODS + ['All'], part_ids + DATA_GROUPS], names=['period', 'entity'])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        completeness_table = pd.DataFrame({
+            'expected_hours': counts['expected_hours'],
+            'observed_hours': counts['observed_hours'].astype(int),
+            'missing_hours': (counts['expected_hours'] - counts['observed_hours']).astype(int),
+            'duplicate_hours': counts['duplicate_hours'].astype(int),
+            'Completeness (%)': counts['observed_hours'] / counts['expected_hours'] * 100,
+            **{f"NaN rate {sensor} (%)": nan_counts[sensor] / counts['rows'] * 100 for sensor in sensor_cols},
+        }, index=index)
+
+    # Runs of consecutive missing hours, found by run-length encoding the expected hours without a row.
+    missing_key = grid_key[~observed]
+    run_starts = np.flatnonzero(np.diff(missing_key, prepend=-2) != 1)
+    run_ends = np.r_[run_starts, len(missing_key)][1:] - 1
+    run_period, run_part = np.unravel_index(missing_key[run_starts] // hour_span, shape)
+    missing_runs = pd.DataFrame({
+        'part_id': np.array(part_ids, dtype=object)[run_part],
+        'period': pd.Categorical.from_codes(run_period, categories=PERIODS, ordered=True),
+        'start': (missing_key[run_starts] % hour_span).astype('datetime64[h]').astype('datetime64[ns]'),
+        'end': (missing_key[run_ends] % hour_span).astype('datetime64[h]').astype('datetime64[ns]'),
+        'hours': run_ends - run_starts + 1,
+    })
+
+    return completeness_table, missing_runs
+
+def prep_summary_stats(cohort_df, environ_var_list, thresholds=EXCEEDANCE_THRESHOLDS):
+    """ Preps for summary statistic (percentiles, max, mean, % above each threshold) calculations for every variable
+    in environ_var_list. Calculations for each participant, all participants combined, and all participants of each
+    group (A, B, C) combined, for each study period and for the whole collection ('All').
+
+    Participant stats are exact and calculated in one batched call to calculate_summary_stats. The combined entries
+    are merged from the participant results: counts, max, mean, and standard deviation exactly, percentiles from merged
+    quantile sketches (see build_quantile_sketches for the error bound), so raw samples are never concatenated across
+    participants. The exceedance percentages come from calculate_exceedance_table.
 
-        # Check if environ_var column exists in the DataFrame
-        if environ_var not in data.columns:
-            raise KeyError(f"{environ_var} column not found in the DataFrame.")
-        else:
-            environ_var_column = data[environ_var]
-            # environ_var_column = environ_var_column.dropna()  # Drop any non numeric values
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'GroupNO', 'period', and one column per sensor variable.
+        environ_var_list (list) : names of the environmental variables to calculate stats for.
+        thresholds (dict) : exceedance thresholds for each variable, see EXCEEDANCE_THRESHOLDS.
+
+    Returns:
+        summary_table (df) : summary statistics indexed by ('variable', 'period', 'entity') with one column per
+        statistic and one column per exceedance label (NaN for variables without that threshold). Entities are each
+        participant followed by each entry of DATA_GROUPS, periods are PERIODS followed by 'All'.
+
+    Raises:
+        KeyError: If one of the environ_var_list columns is not present in the cohort table.
+    """
 
-        # Add the data to the overall data list and to its respective group list.
-        data_groups['overall'].extend(environ_var_column)
-        group = participant_data[part_id]["GroupNO"]
+    # Check if every environ_var column exists in the cohort table
+    missing = [environ_var for environ_var in environ_var_list if environ_var not in cohort_df.columns]
+    if missing:
+        raise KeyError(f"{missing} column(s) not found in the DataFrame.")
+
+    part_ids = list(cohort_df['part_id'].unique())
+    periods = PERIODS + ['All']
+    shape = (len(environ_var_list), len(periods), len(part_ids))
+
+    part_code = pd.Categorical(cohort_df['part_id'], categories=part_ids).codes
+    period_codes = [cohort_df['period'].cat.codes.to_numpy(), np.full(len(cohort_df), len(PERIODS))]
+
+    # Sort every variable's column by value once. The rows stacked below inherit that order, so the stable sort by key
+    # in calculate_summary_stats leaves each participant's values already sorted.
+    values = cohort_df[environ_var_list].to_numpy(dtype=float)
+    order = np.argsort(values, axis=0)
+    values = np.take_along_axis(values, order, axis=0)
+    var_code = np.arange(len(environ_var_list))
+
+    # Stack a copy of the values for each period level (own period and 'All'). Rows with no period and missing values
+    # are dropped.
+    stacked_keys, stacked_values = [], []
+    for period_code in [code[order] for code in period_codes]:
+        key = np.ravel_multi_index((np.broadcast_to(var_code, values.shape), np.maximum(period_code, 0),
+                                    part_code[order]), shape)
+        valid = (period_code >= 0) & ~np.isnan(values)
+        stacked_keys.append(key[valid])
+        stacked_values.append(values[valid])
+
+    keys, summary_statistics = calculate_summary_stats(np.concatenate(stacked_keys), np.concatenate(stacked_values))
+
+    # Spread the participant stats into dense (variable, period, participant) arrays, NaN where there is no data.
+    participant_stats = {}
+    for stat, stat_values in summary_statistics.items():
+        dense = np.zeros(np.prod(shape), dtype=int) if stat == 'count' else np.full(np.prod(shape), np.nan)
+        dense[keys] = stat_values
+        participant_stats[stat] = dense.reshape(shape)
+
+    part_groups = cohort_df.groupby('part_id', sort=False)['GroupNO'].first().reindex(part_ids)
+    sketches = build_quantile_sketches(cohort_df, environ_var_list, part_ids)
+
+    summary_table = assemble_summary_table(participant_stats, sketches, part_groups, environ_var_list)
+    exceedance_table = calculate_exceedance_table(cohort_df, environ_var_list, thresholds)
+    summary_table = add_exceedance_columns(summary_table, exceedance_table)
+
+    return summary_table
+
+def assemble_summary_table(participant_stats, sketches, part_groups, environ_var_list):
+    """ Merges the participant summary statistics into the combined entries and lays everything out as the summary
+    table.
+
+    Args:
+        participant_stats (dict) : each summary statistic as a (variable, period, participant) array.
+        sketches (array) : quantile sketch counts of shape (variable, period, participant, bucket).
+        part_groups (Series) : GroupNO of each participant, indexed by participant ID in the order of the participant
+        axis.
+        environ_var_list (list) : names of the environmental variables, in the order of the variable axis.
 
-        # Assign each entry a color based on the GroupNO
-        if 'color' not in participant_data[part_id].keys():
-            participant_data = assign_color(participant_data, part_id)
+    Returns:
+        summary_table (df) : summary statistics indexed by ('variable', 'period', 'entity') with one column per
+        statistic. Entities are each participant followed by each entry of DATA_GROUPS, periods are PERIODS followed by
+        'All'.
+    """
 
-        if group == 'A':
-            data_groups['group_A'].extend(environ_var_column)
-        elif group == 'B':
-            data_groups['group_B'].extend(environ_var_column)
-        elif group == 'C':
-            data_groups['group_C'].extend(environ_var_column)
+    membership = combined_membership(part_groups)
+    combined_stats = combine_summary_stats(participant_stats, sketches, membership)
 
-        # Create yet another nested dictionary to hold all the summary stats. The key is 'summary_stats' and contains
-        #     # environmental variables as nested keys. If the participant doesn't have a summary_stats key yet, create it.
-        #     # Otherwise, simply add the summary_stats to the corresponding key.
-        if 'summary_stats' not in participant_data[part_id]:
-            participant_data[part_id]['summary_stats'] = pd.DataFrame(columns=environ_var_list)
+    # Ordered categorical levels keep the table in this order and sorted for fast lookups.
+    entities = list(part_groups.index) + DATA_GROUPS
+    levels = [pd.CategoricalIndex(labels, categories=labels, ordered=True) for labels in
+              (environ_var_list, PERIODS + ['All'], entities)]
+    index = pd.MultiIndex.from_product(levels, names=['variable', 'period', 'entity'])
+    summary_table = pd.DataFrame({stat: np.concatenate([participant_stats[stat], combined_stats[stat]], axis=-1).ravel()
+                                  for stat in participant_stats}, index=index)
 
-        # Calculate summary stats for current individual participant. Add the summary stats and the data list to
-        # participant_data
-        summary_statistics = calculate_summary_stats(environ_var_column, environ_var)
-        participant_data[part_id]['summary_stats'][environ_var] = summary_statistics
+    return summary_table
 
-    # Calculate summary stats for all participants combined and for each group combined.
-    for data_grouping, data_list in data_groups.items():
-        summary_statistics = calculate_summary_stats(data_list, environ_var)
+def combined_membership(part_groups):
+    """Marks which participants belong to each combined entry (all participants, and all participants of each group).
 
-        # If the overall category has not been initialized in participant_data yet, initialize it.
-        if data_grouping not in participant_data.keys():
-            participant_data[data_grouping] = {}
-            participant_data[data_grouping]['summary_stats'] = pd.DataFrame(columns=environ_var_list)
-            participant_data[data_grouping]['data'] = pd.DataFrame(columns=environ_var_list)
+    Args:
+        part_groups (Series) : GroupNO of each participant, in the order of the participant axis.
 
-        # Add the summary stats for the combined data to participant_data
-        participant_data[data_grouping]['summary_stats'][environ_var] = summary_statistics
-        participant_data[data_grouping]['data'][environ_var] = data_list
+    Returns:
+        membership (array) : boolean (entry of DATA_GROUPS, participant) array.
+    """
 
-    # Add a "GroupNO" key for all entries in data_groups.
-    for key in data_groups.keys():
-        participant_data[key]["GroupNO"] = 'D'
-        #participant_data[key]["GroupNO"] = key[-1]
+    membership = np.array([np.ones(len(part_groups), dtype=bool)] +
+                          [(part_groups == data_group[-1]).to_numpy() for data_group in DATA_GROUPS[1:]])
 
-        # Assign each entry a color based on the GroupNO
-        if 'color' not in participant_data[key].keys():
-            participant_data = assign_color(participant_data, key)
+    return membership
 
-    return participant_data, data_groups
+def calculate_summary_stats(keys, values):
+    """ Calculate the summary statistics for every group of values at once and return them in a dictionary. A stable
+    sort by key makes every group a contiguous, sorted slice of one array; all percentiles for all groups are then read
+    off that array in a single vectorized step (linear interpolation, matching np.percentile).
 
-def calculate_summary_stats(environ_var_column, environ_var):
-    """ Calculate the summary statistics for a given set of environ_var values and return them in a dictionary.
     Args:
-        environ_var_column (list) : list of environ_var values for an individual participant, all participants, or all participants
-        of one group.
-        environ_var (str) : the current environmental variable name.
+        keys (array) : non-negative integer group key of each value.
+        values (array) : the values to summarize, no NaN. Values sharing a key must be in ascending order.
 
     Returns:
-        summary_statistics (dict) : all the summary statistics from the given PM2.5 values, arranged in dict.
+        unique_keys (array) : the group keys, one per row of the summary statistics.
+        summary_statistics (dict) : each summary statistic as an array aligned with unique_keys.
     """
 
+    percentiles = np.array([10, 25, 50, 75, 90])
+
+    # No values at all (e.g. every requested variable is empty): no groups, and an empty array for each statistic.
+    if len(keys) == 0:
+        statistic_names = ["count", *[f"{percentile}th_percentile" for percentile in percentiles], "Maximum", "Mean",
+                           "Standard deviation"]
+        return keys, {name: np.array([], dtype=int if name == "count" else float) for name in statistic_names}
+
+    # Stable sort by key only; the narrowest integer type lets numpy use a radix sort.
+    order = np.argsort(keys.astype(np.min_scalar_type(keys.max(initial=0))), kind='stable')
+    keys, values = keys[order], values[order]
+
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    ends = starts + counts - 1
+
+    # Fractional position of every percentile in every group, interpolated between the neighbouring sorted values.
+    position = starts[:, None] + percentiles[None, :] / 100 * (counts[:, None] - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, ends[:, None])
+    quantiles = values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    means = np.add.reduceat(values, starts) / counts
+
     # Create a dictionary with the calculated summary statistics
     summary_statistics = {
-        "10th_percentile": np.percentile(environ_var_column, 10),
-        "25th_percentile": np.percentile(environ_var_column, 25),
-        "50th_percentile": np.percentile(environ_var_column, 50),
-        "75th_percentile": np.percentile(environ_var_column, 75),
-        "90th_percentile": np.percentile(environ_var_column, 90),
-        "Maximum": np.max(environ_var_column),
-        "Mean": np.mean(environ_var_column),
-        "Percent above 12": 0
+        "count": counts,
+        **{f"{percentile}th_percentile": quantiles[:, i] for i, percentile in enumerate(percentiles)},
+        "Maximum": values[ends],
+        "Mean": means,
+        "Standard deviation": np.sqrt(np.add.reduceat((values - np.repeat(means, counts)) ** 2, starts) / counts),
     }
 
-    # If we are dealing with pm25, calculate the percentage of time above the threshold of 12.
-    if environ_var == 'pm25':
-        summary_statistics['Percent above 12'] = sum(value > 12 for value in environ_var_column) / len(environ_var_column) * 100
+    return keys[starts], summary_statistics
 
-    return summary_statistics
+def combine_summary_stats(participant_stats, sketches, membership):
+    """ Merges participant summary statistics into the combined entries (all participants, and all participants of
+    each group). Counts, max, mean, and standard deviation are merged exactly; percentiles come from the summed
+    sketches.
 
-def group_lists(participant_data):
-    """Creates 3 lists, one for each educational group, to sort all participant IDs into their respective groups.
+    Args:
+        participant_stats (dict) : each summary statistic as a (variable, period, participant) array.
+        sketches (array) : quantile sketch counts of shape (variable, period, participant, bucket).
+        membership (array) : boolean (combined entry, participant) array, True where the participant belongs to it.
+
+    Returns:
+        combined_stats (dict) : each summary statistic as a (variable, period, combined entry) array.
+    """
+
+    counts = participant_stats['count']
+    weights = membership.T.astype(float)
+
+    # Totals are sums over member participants, means are weighted by each participant's count. The
+    # standard deviation is pooled from each participant's sum of squares, n * (std^2 + mean^2).
+    combined_counts = counts @ membership.T.astype(int)
+    sum_sq = counts * (participant_stats['Standard deviation'] ** 2 + participant_stats['Mean'] ** 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        combined_mean = np.nan_to_num(participant_stats['Mean'] * counts) @ weights / combined_counts
+        combined_stats = {
+            'count': combined_counts,
+            'Maximum': np.fmax.reduce(np.where(membership, participant_stats['Maximum'][..., None, :], np.nan),
+                                      axis=-1),
+            'Mean': combined_mean,
+            'Standard deviation': np.sqrt(np.maximum(np.nan_to_num(sum_sq) @ weights / combined_counts -
+                                                     combined_mean ** 2, 0)),
+        }
+
+    # Merging sketches is a sum of their bucket counts.
+    quantiles = sketch_quantiles(np.einsum('vpek,ge->vpgk', sketches, membership.astype(sketches.dtype)),
+                                 [0.10, 0.25, 0.50, 0.75, 0.90])
+    for i, percentile in enumerate([10, 25, 50, 75, 90]):
+        combined_stats[f"{percentile}th_percentile"] = quantiles[..., i]
+
+    return combined_stats
+
+def sketch_bucket_values():
+    """ Lays out the fixed buckets shared by every quantile sketch: negative buckets (most negative first), one zero
+    bucket for magnitudes below SKETCH_MIN_VALUE, then positive buckets. Bucket i on either side covers magnitudes in
+    (gamma^(i-1), gamma^i] with gamma = (1 + SKETCH_ALPHA) / (1 - SKETCH_ALPHA).
+
+    Returns:
+        bucket_values (array) : the value reported for each bucket, within SKETCH_ALPHA relative error of anything in
+        it.
+    """
+
+    gamma = (1 + SKETCH_ALPHA) / (1 - SKETCH_ALPHA)
+    exponents = np.arange(np.ceil(np.log(SKETCH_MIN_VALUE) / np.log(gamma)),
+                          np.ceil(np.log(SKETCH_MAX_VALUE) / np.log(gamma)) + 1)
+    magnitudes = 2 * gamma ** exponents / (gamma + 1)
+
+    return np.concatenate([-magnitudes[::-1], [0.0], magnitudes])
+
+def sketch_bucket_index(values):
+    """ Finds the sketch bucket of each value (see sketch_bucket_values for the layout). Magnitudes above
+    SKETCH_MAX_VALUE fall in the outermost bucket.
 
     Args:
-        participant_data (dict) : nested dictionary with participant IDs as keys as all data as values.
+        values (array) : values to place in buckets, no NaN.
 
     Returns:
-        educational_groups (dict) : dictionary containing 3 lists. Each list contains all participant IDs from that
-        educational group.
+        bucket_index (array) : index of each value's bucket.
     """
 
-    # Initializes dictionary to contain the IDs of all participants in each educational group.
-    educational_groups = {
-    'A' : [],
-    'B' : [],
-    'C' : []
-    }
+    gamma = (1 + SKETCH_ALPHA) / (1 - SKETCH_ALPHA)
+    min_exponent = np.ceil(np.log(SKETCH_MIN_VALUE) / np.log(gamma))
+    n_side = (len(sketch_bucket_values()) - 1) // 2
 
-    for part_id in participant_data.keys():
-        group = participant_data[part_id]["GroupNO"]
+    magnitude = np.clip(np.abs(values), SKETCH_MIN_VALUE, SKETCH_MAX_VALUE)
+    side_index = (np.ceil(np.log(magnitude) / np.log(gamma)) - min_exponent).astype(int).clip(0, n_side - 1)
 
-        # Records participant ID into one of the 3 educational group lists.
-        if group == 'A':
-            educational_groups['A'].append(part_id)
-        elif group == 'B':
-            educational_groups['B'].append(part_id)
-        elif group == 'C':
-            educational_groups['C'].append(part_id)
+    bucket_index = np.where(values > 0, n_side + 1 + side_index, n_side - 1 - side_index)
+    bucket_index[np.abs(values) < SKETCH_MIN_VALUE] = n_side
 
-    return educational_groups
+    return bucket_index
 
-def graph_group_timeseries(participant_data, educational_groups, data_groups_keys, environ_var, graph_location):
-    """Graphs PM2.5 timeseries data for all particpants of each educational group. Results in 3 graphs.
+def build_quantile_sketches(cohort_df, environ_var_list, part_ids):
+    """ Builds a mergeable quantile sketch for every variable, period (PERIODS followed by 'All'), and participant. A
+    sketch is a vector of counts over fixed logarithmic buckets, so it takes the same memory however much data a
+    participant has, and sketches merge by adding their counts.
+
+    Error bound: a quantile read from a sketch (sketch_quantiles) is within SKETCH_ALPHA relative error of the sample
+    value at rank floor(q * (n - 1)), for values with magnitude between SKETCH_MIN_VALUE and SKETCH_MAX_VALUE. Smaller
+    magnitudes are reported as 0 (absolute error below SKETCH_MIN_VALUE).
 
     Args:
-        participant_data (dict) : nested dictionary with participant IDs as keys as all data as values.
-        educational_groups (dict) : dictionary containing 3 lists. Each list contains all participant IDs from that
-        educational group.
-        data_groups_keys (list) : names of the overall categories: all participants combined, group A combined, group B
-        combined, and group C combined.
-        environ_var (str) : Name of current environmental variable.
-        graph_location (str) : pathway to where graphs are saved
+        cohort_df (df) : cohort table with 'part_id', 'period', and one column per sensor variable.
+        environ_var_list (list) : names of the environmental variables to sketch.
+        part_ids (list) : participant IDs, in the order of the participant axis.
+
+    Returns:
+        sketches (array) : bucket counts of shape (variable, period, participant, bucket).
     """
 
-    # Define a list of colors, line styles, and markers to make lines unique.
-    colors = sns.color_palette('pastel')
-    line_styles = ['-', '--', '-.', ':']
-    markers = ['.', 'o', 'v', '^', 's', 'd']
+    n_buckets = len(sketch_bucket_values())
+    shape = (len(environ_var_list), len(PERIODS) + 1, len(part_ids), n_buckets)
 
-    # Create one graph for each educational group
-    for ed_group in ['A', 'B', 'C']:
-        plt.figure(figsize=(8, 5), dpi=150)
-        title = f'{environ_var} vs Time, Group {ed_group}'
-        plt.title(title, fontdict={'fontweight': 'bold', 'fontsize': 18})
-        plt.xlabel('Timestamp', fontdict={'fontweight': 'bold', 'fontsize': 14})
-        plt.ylabel(f'{environ_var}', fontdict={'fontweight': 'bold', 'fontsize': 14})
-
-        # Go through all participants of the current educational group, plotting PM2.5 vs time.
-        participants = educational_groups[ed_group]
-        for i, part_id in enumerate(participants):
-            # Get the color, line style, and marker for the current participant
-            color = colors[i % len(colors)]
-            line_style = line_styles[i % len(line_styles)]
-            marker = markers[i % len(markers)]
-
-            # If the entry is not one of the overall entries, the data_groups keys, plot PM2.5 vs time using the specified
-            # color, line style, and marker.
-            if part_id not in data_groups_keys:
-                plt.plot(participant_data[part_id]['data']['time'], participant_data[part_id]['data'][environ_var], color=color,
-                     linestyle=line_style, marker=marker, linewidth=1, markersize=2, label=part_id)
-
-        plt.xticks(rotation=45)
-        plt.legend()
+    values = cohort_df[environ_var_list].to_numpy(dtype=float)
+    part_code = np.broadcast_to(pd.Categorical(cohort_df['part_id'], categories=part_ids).codes[:, None], values.shape)
+    period_code = np.broadcast_to(cohort_df['period'].cat.codes.to_numpy()[:, None], values.shape)
+    var_code = np.broadcast_to(np.arange(len(environ_var_list)), values.shape)
 
-        # Save the plot to the specified directory
-        save_graph(graph_location, title.replace(' ', '_'))
+    valid = ~np.isnan(values) & (part_code >= 0)
+    bucket = sketch_bucket_index(values[valid])
 
-    return
+    # Count every value in its own period (if it has one) and in 'All', all with one bincount.
+    in_period = period_code[valid] >= 0
+    flat_index = np.concatenate([
+        np.ravel_multi_index((var_code[valid][in_period], period_code[valid][in_period], part_code[valid][in_period],
+                              bucket[in_period]), shape),
+        np.ravel_multi_index((var_code[valid], np.full(bucket.shape, len(PERIODS)), part_code[valid], bucket), shape),
+    ])
+    sketches = np.bincount(flat_index, minlength=np.prod(shape)).reshape(shape)
 
-def save_graph(graph_location, file_name):
-    # Save the plot to the specified directory
-    file_path = os.path.join(graph_location, file_name)
-    plt.savefig(file_path)
+    return sketches
 
-    return
+def sketch_quantiles(sketches, quantiles):
+    """ Reads quantiles off quantile sketches (see build_quantile_sketches for the error bound).
 
-def plot_summaries(participant_data, legend_elements, environ_var, graph_location):
-    """Creates a bar chart of the 3 summary statistics ('max', 'mean', 'percentage_above_12'). Each of the three charts
-    includes each individual participant, all participants, all Group A, all group B, and all group C. Bars are color-coded
-    by group assignment.
     Args:
-        participant_data (dict) : nested dictionary with participant IDs as keys and all data as values.
-        legend_elements (list) : defines color coding for legend.
-        environ_var (str) : Name of current environmental variable.
-        graph_location (str) : pathway to where graphs are saved.
+        sketches (array) : bucket counts, with the buckets on the last axis.
+        quantiles (list) : quantiles to read, between 0 and 1.
+
+    Returns:
+        sketch_quantiles (array) : shape of sketches without the bucket axis, plus one axis of len(quantiles). NaN for
+        empty sketches.
     """
 
-    participant_ids = list(participant_data.keys())
+    cumulative = np.cumsum(sketches, axis=-1)
+    total = cumulative[..., -1:]
 
-    # Create list of summary stats to be graphed via bar. Everything but percentiles.
-    summary_stats = participant_data[list(participant_data.keys())[0]]['summary_stats'][environ_var].keys()
-    stats_to_graph = []
-    for item in summary_stats:
-        if 'percentile' not in item:
-            stats_to_graph.append(item)
+    # The bucket holding the sample of rank floor(q * (n - 1)) is the first whose cumulative count passes that rank.
+    rank = np.floor(np.asarray(quantiles) * np.maximum(total - 1, 0))
+    bucket = (cumulative[..., None, :] > rank[..., :, None]).argmax(axis=-1)
 
-    # Do no include percent above 12 unless this is pm25
-    if environ_var != 'pm25':
-        stats_to_graph.remove("Percent above 12")
+    return np.where(total > 0, sketch_bucket_values()[bucket], np.nan)
 
-    # Create a bar chart for each summary statistic.
-    for sum_stat in stats_to_graph:
-        plt.figure()
-        plt.figure(figsize=(8, 5), dpi=150)
-        title = f'{environ_var} {sum_stat} vs Participant'
-        plt.title(title, fontdict={'fontweight': 'bold', 'fontsize': 18})
-        plt.xlabel('Participant')
-        plt.ylabel(sum_stat)
+def list_thresholds(environ_var_list, thresholds):
+    """Flattens the exceedance thresholds of every variable in environ_var_list into one list.
 
-        # Retrieve the summary statistic values for each participant, create the bar plot with assigned colors
-        stat_values = []
-        for part_id in participant_ids:
-            stat_values.extend([participant_data[part_id]['summary_stats'].loc[sum_stat, environ_var]])
+    Args:
+        environ_var_list (list) : names of the environmental variables.
+        thresholds (dict) : exceedance thresholds for each variable, see EXCEEDANCE_THRESHOLDS.
+
+    Returns:
+        threshold_list (list) : (variable, label, direction, threshold) for every threshold, in registry order.
+    """
 
-        # Retrieve the colors for each participant
-        colors = [participant_data[part_id]['color'] for part_id in participant_ids]
+    threshold_list = [(environ_var, label, direction, value) for environ_var in environ_var_list
+                      for label, direction, value in thresholds.get(environ_var, [])]
 
-        plt.bar(participant_ids, stat_values, color=colors)
+    return threshold_list
 
-        plt.legend(handles=legend_elements)
-        plt.xticks(rotation=45)
+def flag_exceedances(cohort_df, threshold_list):
+    """Compares every row of the cohort table with every threshold at once.
 
-        # Save the plot to the specified directory
-        save_graph(graph_location, title.replace(' ', '_'))
+    Args:
+        cohort_df (df) : cohort table with one column per sensor variable.
+        threshold_list (list) : (variable, label, direction, threshold) tuples from list_thresholds.
 
-    return
+    Returns:
+        values (array) : (row, threshold) array of the threshold's variable (a variable's column repeats for each of its
+        thresholds).
+        exceeded (array) : boolean (row, threshold) array, True where the value is beyond the threshold. Missing values
+        are never beyond it.
+    """
+
+    values = cohort_df[[environ_var for environ_var, _, _, _ in threshold_list]].to_numpy(dtype=float)
+
+    # '<' thresholds are flipped to '>' by negating both sides; missing values compare as False.
+    sign = np.array([1.0 if direction == '>' else -1.0 for _, _, direction, _ in threshold_list])
+    limits = np.array([value for _, _, _, value in threshold_list], dtype=float)
+    exceeded = values * sign > limits * sign
+
+    return values, exceeded
+
+def count_exceedances(cohort_df, threshold_list, part_ids):
+    """Counts the hours beyond every threshold for every period and participant, comparing every threshold at once as
+    one (row, threshold) array.
 
-def plot_box_whisker(participant_data, legend_elements, environ_var, graph_location):
-    """Creates a box and whisker plot for the 'pm25' values of all participants.
     Args:
-        participant_data (dict) : nested dictionary with participant IDs as keys and all data as values.
-        legend_elements (list) : defines color coding for legend.
-        environ_var (str) : Name of current environmental variable.
-        graph_location (str) : pathway to where graphs are saved.
+        cohort_df (df) : cohort table with 'part_id', 'period', and one column per sensor variable.
+        threshold_list (list) : (variable, label, direction, threshold) tuples from list_thresholds.
+        part_ids (list) : participant IDs, in the order of the participant axis.
+
+    Returns:
+        exceedances (array) : hours beyond each threshold, shape (threshold, period, participant) with periods PERIODS
+        followed by 'All'.
+        hours (array) : hours with a value for the threshold's variable, same shape as exceedances.
     """
-    # Extract participant IDs and their corresponding environ_var values
-    participant_ids = list(participant_data.keys())
 
-    # Create a list of the values to be plotted.
-    environ_var_list = []
-    for part_id in participant_ids:
-        new_list = participant_data[part_id]['data'][environ_var].dropna().tolist()
-        environ_var_list.append(new_list)
+    shape = (len(threshold_list), len(PERIODS) + 1, len(part_ids))
 
-    # Create a box and whisker plot with all participants
-    bp = plt.boxplot(environ_var_list, patch_artist=True, showfliers=False)
+    values, exceeded = flag_exceedances(cohort_df, threshold_list)
+    valid = ~np.isnan(values)
 
-    # Set the x-axis tick labels as participant IDs
-    plt.xticks(range(1, len(participant_ids) + 1), participant_ids)
-    plt.xticks(rotation=45)
+    part_code = np.broadcast_to(pd.Categorical(cohort_df['part_id'], categories=part_ids).codes[:, None], values.shape)
+    period_code = np.broadcast_to(cohort_df['period'].cat.codes.to_numpy()[:, None], values.shape)
+    threshold_code = np.broadcast_to(np.arange(len(threshold_list)), values.shape)
 
-    # Set the facecolor of each box based on participant's color.
-    for i, box in enumerate(bp['boxes']):
-        box.set_facecolor(participant_data[participant_ids[i]]['color'])
+    # Every value counts in its own period (if it has one) and in 'All'.
+    in_period = valid & (period_code >= 0)
+    flat_index = np.concatenate([
+        np.ravel_multi_index((threshold_code[in_period], period_code[in_period], part_code[in_period]), shape),
+        np.ravel_multi_index((threshold_code[valid], np.full(valid.sum(), len(PERIODS)), part_code[valid]), shape),
+    ])
+    flat_exceeded = np.concatenate([exceeded[in_period], exceeded[valid]])
 
-    # Set the color of median line to black
-    for median in bp['medians']:
-        median.set(color='black')
+    exceedances = np.bincount(flat_index, weights=flat_exceeded, minlength=np.prod(shape)).astype(int).reshape(shape)
+    hours = np.bincount(flat_index, minlength=np.prod(shape)).reshape(shape)
 
-    # Set labels and title
-    plt.xlabel('Participant', fontdict={'fontweight': 'bold', 'fontsize': 14})
-    plt.ylabel(environ_var, fontdict={'fontweight': 'bold', 'fontsize': 14})
-    title = f'{environ_var} vs Participant Data Distribution'
-    plt.title(title, fontdict={'fontweight': 'bold', 'fontsize': 18})
-    plt.legend(handles=legend_elements)
-    plt.figure(figsize=(8, 5), dpi=150)
+    return exceedances, hours
 
-    plt.show()
+def exceedance_table_from_counts(exceedances, hours, threshold_list, part_groups, environ_var_list):
+    """Adds the combined entries (all participants, and all participants of each group) to the exceedance counts and
+    lays them out as the exceedance table.
 
-    # # Save the plot to the specified directory
-    # save_graph(graph_location, title.replace(' ', '_'))
+    Args:
+        exceedances (array) : hours beyond each threshold, shape (threshold, period, participant).
+        hours (array) : hours with a value for the threshold's variable, same shape as exceedances.
+        threshold_list (list) : (variable, label, direction, threshold) tuples from list_thresholds.
+        part_groups (Series) : GroupNO of each participant, indexed by participant ID in the order of the participant
+        axis.
+        environ_var_list (list) : names of the environmental variables.
 
-    return
+    Returns:
+        exceedance_table (df) : 'hours', 'exceedances', and 'Percent' indexed by ('variable', 'threshold', 'period',
+        'entity').
+    """
+
+    # Counts are additive, so the combined entries are sums over their member participants.
+    membership = combined_membership(part_groups).T.astype(int)
+    exceedances = np.concatenate([exceedances, exceedances @ membership], axis=-1)
+    hours = np.concatenate([hours, hours @ membership], axis=-1)
+
+    labels = list(dict.fromkeys(label for _, label, _, _ in threshold_list))
+    entities = list(part_groups.index) + DATA_GROUPS
+    periods = PERIODS + ['All']
+
+    # Each threshold row is repeated for every (period, entity) cell, in the order of the flattened arrays.
+    cells = len(periods) * len(entities)
+    var_idx = np.repeat([environ_var_list.index(environ_var) for environ_var, _, _, _ in threshold_list], cells)
+    label_idx = np.repeat([labels.index(label) for _, label, _, _ in threshold_list], cells)
+    period_idx = np.tile(np.repeat(np.arange(len(periods)), len(entities)), len(threshold_list))
+    entity_idx = np.tile(np.arange(len(entities)), len(threshold_list) * len(periods))
+
+    levels = [pd.CategoricalIndex(level, categories=level, ordered=True) for level in
+              (environ_var_list, labels, periods, entities)]
+    index = pd.MultiIndex(levels=levels, codes=[var_idx, label_idx, period_idx, entity_idx],
+                          names=['variable', 'threshold', 'period', 'entity'])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        exceedance_table = pd.DataFrame({'hours': hours.ravel(), 'exceedances': exceedances.ravel(),
+                                         'Percent': (exceedances / hours * 100).ravel()}, index=index)
+
+    return exceedance_table
+
+def calculate_exceedance_table(cohort_df, environ_var_list, thresholds=EXCEEDANCE_THRESHOLDS):
+    """Calculates the percentage of hours beyond every threshold of every variable in environ_var_list, for each
+    participant, all participants combined, and all participants of each group, for each study period and 'All'.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'GroupNO', 'period', and one column per sensor variable.
+        environ_var_list (list) : names of the environmental variables.
+        thresholds (dict) : exceedance thresholds for each variable, see EXCEEDANCE_THRESHOLDS.
+
+    Returns:
+        exceedance_table (df) : 'hours', 'exceedances', and 'Percent' indexed by ('variable', 'threshold', 'period',
+        'entity').
+    """
+
+    threshold_list = list_thresholds(environ_var_list, thresholds)
+    part_ids = list(cohort_df['part_id'].unique())
+    part_groups = cohort_df.groupby('part_id', sort=False)['GroupNO'].first().reindex(part_ids)
+
+    exceedances, hours = count_exceedances(cohort_df, threshold_list, part_ids)
+    exceedance_table = exceedance_table_from_counts(exceedances, hours, threshold_list, part_groups, environ_var_list)
+
+    return exceedance_table
+
+def add_exceedance_columns(summary_table, exceedance_table):
+    """Adds one column per exceedance label to the summary table, holding the percentage of hours beyond it. Variables
+    without that threshold are NaN.
+
+    Args:
+        summary_table (df) : summary statistics indexed by ('variable', 'period', 'entity').
+        exceedance_table (df) : exceedance table from calculate_exceedance_table.
+
+    Returns:
+        summary_table (df) : the summary statistics with the exceedance columns added.
+    """
+
+    percent = exceedance_table['Percent'].unstack('threshold')
+    labels = list(exceedance_table.index.levels[1])
+
+    summary_table = summary_table.join(percent.reindex(summary_table.index)[labels])
+
+    return summary_table
+
+def detect_exceedance_episodes(cohort_df, environ_var_list, thresholds=EXCEEDANCE_THRESHOLDS,
+                               max_gap=pd.Timedelta(minutes=90)):
+    """Finds every exceedance episode (a run of consecutive hours beyond a threshold) for every participant, variable,
+    and threshold. The runs are found with run-length encoding over the whole cohort table at once: an episode starts
+    wherever a row is beyond the threshold and the row before it is not, belongs to another participant, or is more
+    than max_gap earlier (missing hours end an episode).
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'GroupNO', 'period', 'time', and one column per sensor variable,
+        sorted by participant and time.
+        environ_var_list (list) : names of the environmental variables.
+        thresholds (dict) : exceedance thresholds for each variable, see EXCEEDANCE_THRESHOLDS.
+        max_gap (Timedelta) : longest time between two rows of the same episode.
+
+    Returns:
+        episodes (df) : one row per episode with 'part_id', 'GroupNO', 'period' (at the start), 'variable', 'threshold',
+        'start', 'end', 'hours' (rows in the episode), 'duration_hours', 'peak' (furthest value beyond the threshold),
+        and 'peak_time'.
+    """
+
+    threshold_list = list_thresholds(environ_var_list, thresholds)
+    values, exceeded = flag_exceedances(cohort_df, threshold_list)
+    sign = np.array([1.0 if direction == '>' else -1.0 for _, _, direction, _ in threshold_list])
+
+    # A row continues the previous row's run only if it is the same participant, within max_gap, and also beyond.
+    part_id = cohort_df['part_id'].to_numpy()
+    time = cohort_df['time'].to_numpy('datetime64[ns]')
+    continues = np.r_[False, (part_id[1:] == part_id[:-1]) & (np.diff(time) <= max_gap.to_timedelta64())]
+    starts = exceeded & ~(continues[:, None] & np.r_[np.zeros((1, exceeded.shape[1]), dtype=bool), exceeded[:-1]])
+
+    # Lay each threshold's column end to end and keep only the rows beyond it, so every episode is a contiguous slice.
+    threshold_idx, row_idx = np.nonzero(exceeded.T)
+    episode_starts = np.flatnonzero(starts.T[exceeded.T])
+    episode_ends = np.r_[episode_starts, len(row_idx)][1:] - 1
+
+    # Peak of each episode and the first row where it is reached, using signed values so '<' peaks are minimums.
+    signed_values = values[row_idx, threshold_idx] * sign[threshold_idx]
+    peaks = np.maximum.reduceat(signed_values, episode_starts)
+    at_peak = np.flatnonzero(signed_values == np.repeat(peaks, episode_ends - episode_starts + 1))
+    peak_episode = np.searchsorted(episode_starts, at_peak, side='right') - 1
+    peak_rows = row_idx[at_peak[np.flatnonzero(np.diff(peak_episode, prepend=-1))]]
+
+    start_rows, end_rows = row_idx[episode_starts], row_idx[episode_ends]
+    episode_thresholds = threshold_idx[episode_starts]
+    threshold_vars = np.array([environ_var for environ_var, _, _, _ in threshold_list], dtype=object)
+    threshold_labels = np.array([label for _, label, _, _ in threshold_list], dtype=object)
+    episodes = pd.DataFrame({
+        'part_id': part_id[start_rows],
+        'GroupNO': cohort_df['GroupNO'].to_numpy()[start_rows],
+        'period': cohort_df['period'].to_numpy()[start_rows],
+        'variable': threshold_vars[episode_thresholds],
+        'threshold': threshold_labels[episode_thresholds],
+        'start': time[start_rows],
+        'end': time[end_rows],
+        'hours': episode_ends - episode_starts + 1,
+        'duration_hours': (time[end_rows] - time[start_rows]) / np.timedelta64(1, 'h') + 1,
+        'peak': peaks * sign[episode_thresholds],
+        'peak_time': time[peak_rows],
+    })
+
+    return episodes
+
+def summarize_episodes(episodes, thresholds=EXCEEDANCE_THRESHOLDS):
+    """Summarizes the exceedance episodes of each participant for each variable and threshold: the number of episodes,
+    the distribution of their durations, and the furthest peak.
+
+    Args:
+        episodes (df) : exceedance episodes from detect_exceedance_episodes.
+        thresholds (dict) : exceedance thresholds for each variable, see EXCEEDANCE_THRESHOLDS.
+
+    Returns:
+        episode_summary (df) : indexed by ('variable', 'threshold', 'part_id') with 'episodes', 'total_hours', duration
+        'mean', 'median', '90th_percentile', and 'longest' (in hours), and 'peak'.
+    """
+
+    # Signed peaks make the furthest peak a maximum for both '>' and '<' thresholds.
+    directions = {(environ_var, label): 1.0 if direction == '>' else -1.0
+                  for environ_var, entries in thresholds.items() for label, direction, _ in entries}
+    sign = pd.Series([directions[key] for key in zip(episodes['variable'], episodes['threshold'])], dtype=float,
+                     index=episodes.index)
+
+    grouped = episodes.assign(signed_peak=episodes['peak'] * sign, sign=sign).groupby(
+        ['variable', 'threshold', 'part_id'], sort=False)
+    durations = grouped['duration_hours']
+
+    episode_summary = pd.DataFrame({
+        'episodes': grouped.size(),
+        'total_hours': grouped['hours'].sum(),
+        'mean': durations.mean(),
+        'median': durations.median(),
+        '90th_percentile': durations.quantile(0.9),
+        'longest': durations.max(),
+        'peak': grouped['signed_peak'].max() * grouped['sign'].first(),
+    })
+
+    return episode_summary
+
+def calculate_sample_weights(cohort_df, max_interval=MAX_SAMPLE_INTERVAL):
+    """Calculates the time each row of the cohort table represents: the time until the participant's next row in the
+    same period, capped at max_interval so that a device that went offline does not stretch its last sample over the
+    whole outage. The last row of each participant and period represents the nominal sampling interval of one hour.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'period', and 'time' columns, sorted by participant and time.
+        max_interval (Timedelta) : longest time a single row can represent.
+
+    Returns:
+        weights (array) : hours represented by each row of cohort_df.
+    """
+
+    part_code = pd.factorize(cohort_df['part_id'])[0]
+    period_code = cohort_df['period'].cat.codes.to_numpy()
+    time = cohort_df['time'].to_numpy('datetime64[ns]')
+
+    # The interval to the next row only counts if that row belongs to the same participant and period.
+    same_run = (np.diff(part_code, append=-1) == 0) & (np.diff(period_code, append=-2) == 0)
+    intervals = np.diff(time, append=time[-1:]) / np.timedelta64(1, 'h')
+    weights = np.minimum(np.where(same_run, intervals, 1.0), max_interval / pd.Timedelta(hours=1))
+
+    return weights
+
+def calculate_gap_metadata(cohort_df, participant_meta, max_interval=MAX_SAMPLE_INTERVAL):
+    """Calculates the longest data gap and the coverage of every participant in every study period. The gaps include
+    the time from the start of the period to the first row and from the last row to the end of the period. Coverage is
+    the observed hours as a percentage of the expected hours, counted like the completeness report (match_hour_grid),
+    so each row counts for at most its own hour. The weighted span is the time the rows represent in the time-weighted
+    stats (see calculate_sample_weights, up to max_interval per row) as a percentage of the period length.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'period', and 'time' columns, sorted by participant and time.
+        participant_meta (df) : participant metadata indexed by 'part_id' with one column per visit date.
+        max_interval (Timedelta) : longest time a single row can represent.
+
+    Returns:
+        gap_table (df) : gap metadata indexed by ('period', 'entity') with 'Longest gap (hours)', 'Coverage (%)', and
+        'Weighted span (%)' columns. Periods are PERIODS followed by 'All' (the longest gap and overall coverage of all
+        periods).
+    """
+
+    part_ids = list(participant_meta.index)
+    shape = (len(PERIODS), len(part_ids))
+
+    in_period = cohort_df['period'].notna().to_numpy()
+    part_code = pd.Categorical(cohort_df['part_id'], categories=part_ids).codes[in_period]
+    period_code = cohort_df['period'].cat.codes.to_numpy()[in_period]
+    time = cohort_df['time'].to_numpy('datetime64[ns]')[in_period]
+    weights = calculate_sample_weights(cohort_df, max_interval)[in_period]
+    key = np.ravel_multi_index((period_code, part_code), shape)
+
+    # Start and end of every participant's periods, visits 1-2, 2B-3, and 3B-4, as (period, participant) arrays.
+    visits = participant_meta[['1', '2', '2B', '3', '3B', '4']].to_numpy('datetime64[ns]').T
+    period_start, period_end = visits[0::2], visits[1::2]
+    period_hours = (period_end - period_start) / np.timedelta64(1, 'h')
+
+    # Gaps between consecutive rows of the same participant and period, then the gaps at each end of the period. A
+    # period without any rows is one gap over its whole length.
+    first_row = np.diff(key, prepend=-1) != 0
+    last_row = np.diff(key, append=-1) != 0
+    inner_gaps = np.where(first_row, 0.0, np.diff(time, prepend=time[:1]) / np.timedelta64(1, 'h'))
+    longest_gap = period_hours.ravel().copy()
+    longest_gap[np.unique(key)] = 0.0
+    np.fmax.at(longest_gap, key, inner_gaps)
+    np.fmax.at(longest_gap, key[first_row], (time[first_row] - period_start.ravel()[key[first_row]]) /
+               np.timedelta64(1, 'h'))
+    np.fmax.at(longest_gap, key[last_row], (period_end.ravel()[key[last_row]] - time[last_row]) /
+               np.timedelta64(1, 'h'))
+    longest_gap = longest_gap.reshape(shape)
+
+    grid_key, hour_span, observed, _, _, _, _ = match_hour_grid(cohort_df, participant_meta)
+    expected_hours = np.bincount(grid_key // hour_span, minlength=np.prod(shape)).reshape(shape)
+    observed_hours = np.bincount(grid_key // hour_span, weights=observed, minlength=np.prod(shape)).reshape(shape)
+
+    weighted_hours = np.bincount(key, weights=weights, minlength=np.prod(shape)).reshape(shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        coverage = observed_hours / expected_hours * 100
+        all_coverage = observed_hours.sum(axis=0) / expected_hours.sum(axis=0) * 100
+        weighted_span = np.minimum(weighted_hours / period_hours * 100, 100)
+        all_weighted_span = np.minimum(weighted_hours.sum(axis=0) / period_hours.sum(axis=0) * 100, 100)
+
+    index = pd.MultiIndex.from_product([PERIODS + ['All'], part_ids], names=['period', 'entity'])
+    gap_table = pd.DataFrame({
+        'Longest gap (hours)': np.vstack([longest_gap, np.fmax.reduce(longest_gap, axis=0)]).ravel(),
+        'Coverage (%)': np.vstack([coverage, all_coverage]).ravel(),
+        'Weighted span (%)': np.vstack([weighted_span, all_weighted_span]).ravel(),
+    }, index=index)
+
+    return gap_table
+
+def calculate_time_weighted_stats(cohort_df, participant_meta, environ_var_list, max_interval=MAX_SAMPLE_INTERVAL):
+    """Calculates time-weighted summary statistics (percentiles, mean, standard deviation) for every participant,
+    variable, and period, weighting each row by the time it represents (see calculate_sample_weights) so that dense
+    stretches of data do not outweigh sparse ones. Percentiles are the first value whose cumulative weight reaches the
+    percentile. All groups are calculated at once from one sorted array. The gap metadata of each participant and
+    period is added to the table.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'period', 'time', and one column per sensor variable, sorted by
+        participant and time.
+        participant_meta (df) : participant metadata indexed by 'part_id' with one column per visit date.
+        environ_var_list (list) : names of the environmental variables to calculate stats for.
+        max_interval (Timedelta) : longest time a single row can represent.
+
+    Returns:
+        weighted_table (df) : time-weighted statistics indexed by ('variable', 'period', 'entity') with 'hours' (the
+        total weight), percentile, 'Mean', 'Standard deviation', and the gap metadata columns of
+        calculate_gap_metadata. Periods are PERIODS followed by 'All'.
+    """
+
+    percentiles = np.array([10, 25, 50, 75, 90])
+    part_ids = list(participant_meta.index)
+    periods = PERIODS + ['All']
+    shape = (len(environ_var_list), len(periods), len(part_ids))
+
+    part_code = pd.Categorical(cohort_df['part_id'], categories=part_ids).codes
+    period_codes = [cohort_df['period'].cat.codes.to_numpy(), np.full(len(cohort_df), len(PERIODS))]
+    row_weights = calculate_sample_weights(cohort_df, max_interval)
+
+    # Sort every variable's column by value once and stack a copy for each period level, as in prep_summary_stats.
+    values = cohort_df[environ_var_list].to_numpy(dtype=float)
+    order = np.argsort(values, axis=0)
+    values = np.take_along_axis(values, order, axis=0)
+    var_code = np.broadcast_to(np.arange(len(environ_var_list)), values.shape)
+    stacked_keys, stacked_values, stacked_weights = [], [], []
+    for period_code in [code[order] for code in period_codes]:
+        key = np.ravel_multi_index((var_code, np.maximum(period_code, 0), part_code[order]), shape)
+        valid = (period_code >= 0) & ~np.isnan(values)
+        stacked_keys.append(key[valid])
+        stacked_values.append(values[valid])
+        stacked_weights.append(row_weights[order][valid])
+    keys, values, weights = (np.concatenate(stacked) for stacked in (stacked_keys, stacked_values, stacked_weights))
+
+    # Stable sort by key so that each group is a contiguous slice, still sorted by value.
+    group_order = np.argsort(keys.astype(np.min_scalar_type(keys.max(initial=0))), kind='stable')
+    keys, values, weights = keys[group_order], values[group_order], weights[group_order]
+    starts = np.flatnonzero(np.diff(keys, prepend=-1))
+    counts = np.diff(np.r_[starts, len(keys)])
+
+    # Weighted percentiles: search the running total of the weights for each group's target weight.
+    running_weight = np.cumsum(weights)
+    total_weight = np.add.reduceat(weights, starts)
+    weight_before = running_weight[starts] - weights[starts]
+    targets = weight_before[:, None] + percentiles[None, :] / 100 * total_weight[:, None]
+    positions = np.minimum(np.searchsorted(running_weight, targets, side='left'), (starts + counts - 1)[:, None])
+
+    means = np.add.reduceat(weights * values, starts) / total_weight
+    variances = np.add.reduceat(weights * (values - np.repeat(means, counts)) ** 2, starts) / total_weight
+    weighted_stats = {
+        'hours': total_weight,
+        **{f"{percentile}th_percentile": values[positions[:, i]] for i, percentile in enumerate(percentiles)},
+        'Mean': means,
+        'Standard deviation': np.sqrt(variances),
+    }
+
+    # Spread the stats into the dense (variable, period, participant) layout, NaN where there is no data.
+    columns = {}
+    for stat, stat_values in weighted_stats.items():
+        dense = np.zeros(np.prod(shape)) if stat == 'hours' else np.full(np.prod(shape), np.nan)
+        dense[keys[starts]] = stat_values
+        columns[stat] = dense
+
+    levels = [pd.CategoricalIndex(labels, categories=labels, ordered=True) for labels in
+              (environ_var_list, periods, part_ids)]
+    index = pd.MultiIndex.from_product(levels, names=['variable', 'period', 'entity'])
+    weighted_table = pd.DataFrame(columns, index=index)
+
+    # Every variable of a participant and period shares the same gap metadata.
+    gap_table = calculate_gap_metadata(cohort_df, participant_meta, max_interval)
+    gap_values = gap_table.to_numpy().reshape(len(periods), len(part_ids), -1)
+    for i, column in enumerate(gap_table.columns):
+        weighted_table[column] = np.broadcast_to(gap_values[..., i], shape).ravel()
+
+    return weighted_table
+
+def participant_period_deltas(summary_table, environ_var_list, part_ids, contrasts=EFFECT_CONTRASTS):
+    """Calculates each participant's change in mean between study periods (e.g. Intervention - Baseline) for every
+    variable, from the participant means in the summary table.
+
+    Args:
+        summary_table (df) : summary statistics indexed by ('variable', 'period', 'entity') with a 'Mean' column.
+        environ_var_list (list) : names of the environmental variables.
+        part_ids (list) : participant IDs, in the order of the participant axis.
+        contrasts (list) : (period, reference period) pairs, see EFFECT_CONTRASTS.
+
+    Returns:
+        deltas (array) : (variable, contrast, participant) array of the changes in mean, NaN where the participant has
+        no data in one of the periods.
+    """
+
+    index = pd.MultiIndex.from_product([environ_var_list, PERIODS, part_ids])
+    means = summary_table['Mean'].reindex(index).to_numpy(dtype=float)
+    means = means.reshape(len(environ_var_list), len(PERIODS), len(part_ids))
+
+    period_idx = np.array([PERIODS.index(period) for period, _ in contrasts], dtype=int)
+    reference_idx = np.array([PERIODS.index(reference) for _, reference in contrasts], dtype=int)
+    deltas = means[:, period_idx] - means[:, reference_idx]
+
+    return deltas
+
+def bootstrap_group_means(deltas, membership, n_boot, seed_seq):
+    """Draws bootstrap replicates of the mean participant delta of every combined entry. For every variable and
+    contrast, each replicate resamples, with replacement, the entry's participants that have a delta; all replicates
+    are drawn as one index matrix and reduced in one step.
+
+    Args:
+        deltas (array) : (variable, contrast, participant) array from participant_period_deltas.
+        membership (array) : boolean (combined entry, participant) array from combined_membership.
+        n_boot (int) : number of bootstrap replicates.
+        seed_seq (SeedSequence) : seed of the random number generator, so the replicates are reproducible.
+
+    Returns:
+        replicates (array) : (combined entry, replicate, variable, contrast) array of the resampled mean deltas.
+    """
+
+    rng = np.random.default_rng(seed_seq)
+    replicates = np.full((len(membership), n_boot) + deltas.shape[:2], np.nan)
+
+    for g, members in enumerate(membership):
+        member_deltas = deltas[..., members]
+        n_members = member_deltas.shape[-1]
+        if n_members == 0:
+            continue
+
+        # Put the participants with a delta first for every (variable, contrast), so that drawing positions below
+        # their number only ever draws participants with data.
+        has_delta = ~np.isnan(member_deltas)
+        n_valid = has_delta.sum(axis=-1)
+        compact = np.take_along_axis(member_deltas, np.argsort(~has_delta, axis=-1, kind='stable'), axis=-1)
+
+        # (variable, contrast, replicate, draw) matrix of positions; each replicate uses its first n_valid draws.
+        positions = (rng.random(deltas.shape[:2] + (n_boot, n_members)) * n_valid[..., None, None]).astype(int)
+        draws = np.take_along_axis(compact[..., None, :], positions, axis=-1)
+        in_replicate = np.arange(n_members) < n_valid[..., None, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(in_replicate, draws, 0).sum(axis=-1) / n_valid[..., None]
+        replicates[g] = np.moveaxis(means, -1, 0)
+
+    return replicates
+
+def calculate_effect_table(summary_table, participant_meta, environ_var_list, contrasts=EFFECT_CONTRASTS,
+                           n_boot=2000, confidence=95, seed=0, workers=None):
+    """Calculates the intervention effects for every variable: each participant's change in mean between periods
+    (participant_period_deltas), the mean change of all participants and of each group, and the differences in mean
+    change between groups, with percentile bootstrap confidence intervals resampling participants.
+
+    The replicates are drawn in fixed chunks, each with its own child of the seeded SeedSequence, so the results are
+    the same whether the chunks run in this process or spread across worker processes.
+
+    Args:
+        summary_table (df) : summary statistics indexed by ('variable', 'period', 'entity') with a 'Mean' column.
+        participant_meta (df) : participant metadata indexed by 'part_id' with a 'GroupNO' column.
+        environ_var_list (list) : names of the environmental variables.
+        contrasts (list) : (period, reference period) pairs, see EFFECT_CONTRASTS.
+        n_boot (int) : number of bootstrap replicates.
+        confidence (float) : confidence level of the intervals, in percent.
+        seed (int) : seed of the random number generator.
+        workers (int) : number of worker processes for the bootstrap, or None to run it in this process.
+
+    Returns:
+        effect_table (df) : effects indexed by ('variable', 'contrast', 'entity') with 'n' (participants with data, the
+        smaller group for comparisons), 'Effect', 'CI low', and 'CI high' columns. Entities are each participant (no
+        interval), each entry of DATA_GROUPS, and each group comparison ('group_B - group_A', ...).
+    """
+
+    part_ids = list(participant_meta.index)
+    deltas = participant_period_deltas(summary_table, environ_var_list, part_ids, contrasts)
+    membership = combined_membership(participant_meta['GroupNO'])
+
+    # Fixed-size chunks of replicates, each seeded from its own child sequence.
+    chunk_sizes = np.diff(np.r_[np.arange(0, n_boot, BOOTSTRAP_CHUNK), n_boot])
+    seed_seqs = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    chunk_args = ([deltas] * len(chunk_sizes), [membership] * len(chunk_sizes), chunk_sizes, seed_seqs)
+    if workers:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(bootstrap_group_means, *chunk_args))
+    else:
+        chunks = list(map(bootstrap_group_means, *chunk_args))
+    replicates = np.concatenate(chunks, axis=1)
+
+    # Point estimates and replicates of the group comparisons are differences of the group means.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        counts = (~np.isnan(deltas)) @ membership.T.astype(int)
+        group_effects = np.nansum(deltas[..., None, :] * np.where(membership, 1.0, np.nan), axis=-1) / counts
+    comparisons = list(itertools.combinations(range(1, len(DATA_GROUPS)), 2))
+    comparison_labels = [f'{DATA_GROUPS[second]} - {DATA_GROUPS[first]}' for first, second in comparisons]
+    first_idx, second_idx = (np.array(idx, dtype=int) for idx in zip(*comparisons))
+    effects = np.concatenate([group_effects, group_effects[..., second_idx] - group_effects[..., first_idx]], axis=-1)
+    replicates = np.concatenate([replicates, replicates[second_idx] - replicates[first_idx]], axis=0)
+    comparison_counts = np.minimum(counts[..., first_idx], counts[..., second_idx])
+
+    # Percentile intervals, NaN only for entries (or comparisons) without any participant with data.
+    tail = (100 - confidence) / 2
+    ci_low, ci_high = np.percentile(replicates, [tail, 100 - tail], axis=1).transpose(0, 2, 3, 1)
+
+    contrast_labels = [f'{period} - {reference}' for period, reference in contrasts]
+    entities = part_ids + DATA_GROUPS + comparison_labels
+    levels = [pd.CategoricalIndex(labels, categories=labels, ordered=True) for labels in
+              (environ_var_list, contrast_labels, entities)]
+    index = pd.MultiIndex.from_product(levels, names=['variable', 'contrast', 'entity'])
+    no_interval = np.full(deltas.shape, np.nan)
+    effect_table = pd.DataFrame({
+        'n': np.concatenate([(~np.isnan(deltas)).astype(int), counts, comparison_counts], axis=-1).ravel(),
+        'Effect': np.concatenate([deltas, effects], axis=-1).ravel(),
+        'CI low': np.concatenate([no_interval, ci_low], axis=-1).ravel(),
+        'CI high': np.concatenate([no_interval, ci_high], axis=-1).ravel(),
+    }, index=index)
+
+    return effect_table
+
+def period_group_design(cohort_df):
+    """Builds the design matrix of the period x group model: an intercept, the Intervention and Follow_Up periods,
+    groups B and C, and every period x group interaction, with Baseline and group A as the reference levels (as in the
+    R model).
+
+    Args:
+        cohort_df (df) : cohort table with 'GroupNO' and 'period' columns.
+
+    Returns:
+        design (array) : (row, term) float array, zero rows where the row has no period or group.
+        terms (list) : names of the terms, in column order.
+    """
+
+    period_dummies = cohort_df['period'].cat.codes.to_numpy()[:, None] == np.arange(1, len(PERIODS))
+    group_dummies = cohort_df['GroupNO'].to_numpy()[:, None] == np.array(['B', 'C'], dtype=object)
+    interactions = period_dummies[:, :, None] & group_dummies[:, None, :]
+    interactions = interactions.reshape(len(cohort_df), period_dummies.shape[1] * group_dummies.shape[1])
+    design = np.hstack([np.ones((len(cohort_df), 1)), period_dummies, group_dummies, interactions]).astype(float)
+
+    terms = (['(Intercept)'] + [f'period{period}' for period in PERIODS[1:]] + [f'Group{group}' for group in 'BC'] +
+             [f'period{period}:Group{group}' for period in PERIODS[1:] for group in 'BC'])
+
+    return design, terms
+
+def fit_period_group_model(cohort_df, environ_var_list):
+    """Fits the period x group linear model (value ~ period * GroupNO) to the hourly data of every variable by least
+    squares, with standard errors that are robust to the correlation of hours from the same participant (CR1 cluster
+    robust, clustered by participant). Runs directly on the cohort table, replacing the hand-off to the R script.
+
+    P-values use a t distribution with G - 1 degrees of freedom, G the number of participants (clusters), rather than
+    the normal distribution, which would understate them with only a few participants per group.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'GroupNO', 'period', and one column per sensor variable.
+        environ_var_list (list) : names of the environmental variables to model.
+
+    Returns:
+        model_table (df) : coefficients indexed by ('variable', 'term') with 'Estimate', 'Std. Error', 't value',
+        'Pr(>|t|)', and 'df' (degrees of freedom) columns, and the number of hours and participants (clusters) the
+        model was fit to.
+    """
+
+    design, terms = period_group_design(cohort_df)
+    in_model = cohort_df['period'].notna().to_numpy() & cohort_df['GroupNO'].isin(['A', 'B', 'C']).to_numpy()
+    cluster = pd.factorize(cohort_df['part_id'])[0]
+
+    model_tables = []
+    for environ_var in environ_var_list:
+        values = cohort_df[environ_var].to_numpy(dtype=float)
+        rows = in_model & ~np.isnan(values)
+        X, y = design[rows], values[rows]
+
+        # Least squares through the normal equations; pinv handles terms with no data (e.g. an empty group).
+        bread = np.linalg.pinv(X.T @ X)
+        coefficients = bread @ (X.T @ y)
+        residuals = y - X @ coefficients
+
+        # Sum the score of every hour within its participant, sorting once so every participant is one slice.
+        order = np.argsort(cluster[rows], kind='stable')
+        sorted_clusters = cluster[rows][order]
+        starts = np.flatnonzero(np.diff(sorted_clusters, prepend=-1))
+        cluster_scores = np.add.reduceat((X * residuals[:, None])[order], starts, axis=0)
+        n_clusters, n_obs = len(starts), len(y)
+        n_terms = np.linalg.matrix_rank(X) if n_obs else 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            correction = (n_clusters / (n_clusters - 1) * (n_obs - 1) / (n_obs - n_terms) if
+                          n_clusters > 1 and n_obs > n_terms else np.nan)
+            covariance = correction * bread @ (cluster_scores.T @ cluster_scores) @ bread
+            std_errors = np.sqrt(np.diag(covariance))
+
+            # Terms without any hours (e.g. a group with no participants) are not estimable.
+            estimable = X.any(axis=0)
+            coefficients[~estimable], std_errors[~estimable] = np.nan, np.nan
+            t_values = coefficients / std_errors
+        degrees_of_freedom = n_clusters - 1
+        p_values = np.array([t_test_p_value(t_value, degrees_of_freedom) for t_value in t_values])
+
+        model_tables.append(pd.DataFrame({
+            'Estimate': coefficients,
+            'Std. Error': std_errors,
+            't value': t_values,
+            'Pr(>|t|)': p_values,
+            'df': degrees_of_freedom,
+            'hours': n_obs,
+            'participants': n_clusters,
+        }, index=pd.Index(terms, name='term')))
+
+    model_table = pd.concat(model_tables, keys=environ_var_list, names=['variable'])
+
+    return model_table
+
+def t_test_p_value(t_value, degrees_of_freedom):
+    """Calculates the two-sided p-value of a t statistic, P(|T| > |t_value|) for T with a t distribution, through the
+    regularized incomplete beta function: P = I_x(df / 2, 1 / 2) with x = df / (df + t^2).
+
+    Args:
+        t_value (float) : the t statistic.
+        degrees_of_freedom (int) : degrees of freedom of the t distribution.
+
+    Returns:
+        p_value (float) : the two-sided p-value, NaN if t_value is not finite or there are no degrees of freedom.
+    """
+
+    if not np.isfinite(t_value) or degrees_of_freedom < 1:
+        return np.nan
+
+    x = degrees_of_freedom / (degrees_of_freedom + t_value ** 2)
+
+    return regularized_incomplete_beta(x, degrees_of_freedom / 2, 0.5)
+
+def regularized_incomplete_beta(x, a, b):
+    """Calculates the regularized incomplete beta function I_x(a, b) with its continued fraction (modified Lentz
+    method), using the symmetry I_x(a, b) = 1 - I_(1-x)(b, a) where the fraction converges slowly.
+
+    Args:
+        x (float) : upper limit of the integral, between 0 and 1.
+        a (float) : first shape parameter, positive.
+        b (float) : second shape parameter, positive.
+
+    Returns:
+        value (float) : I_x(a, b).
+    """
+
+    if x <= 0 or x >= 1:
+        return float(x >= 1)
+    if x > (a + 1) / (a + b + 2):
+        return 1 - regularized_incomplete_beta(1 - x, b, a)
+
+    log_front = math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x)
+    tiny = 1e-300
+    c, d = 1.0, 1 - (a + b) * x / (a + 1)
+    d = 1 / (d if abs(d) > tiny else tiny)
+    fraction = d
+    for m in range(1, 300):
+        # Even and odd terms of the continued fraction.
+        for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                          -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            fraction *= c * d
+        if abs(c * d - 1) < 1e-15:
+            break
+
+    return math.exp(log_front) * fraction / a
+
+def add_rolling_metrics(cohort_df, rolling_metrics=ROLLING_METRICS):
+    """Adds a column for each rolling-window metric to the cohort table: the mean of the variable over the trailing
+    window (time - window, time] of the same participant. Every window is read off one cumulative sum over the whole
+    cohort table, so no per-window copies are made. Missing hours simply shorten a window's data; a window with fewer
+    than the minimum hours of data is NaN.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'time', and one column per sensor variable, sorted by participant
+        and time.
+        rolling_metrics (dict) : rolling-window metrics, see ROLLING_METRICS.
+
+    Returns:
+        cohort_df (df) : the cohort table with one column per rolling metric added.
+    """
+
+    # Hours since the start of the data, pushed further apart for each participant so that one sorted key covers the
+    # whole table and a window never reaches back into the previous participant.
+    hours = ((cohort_df['time'] - cohort_df['time'].min()) / pd.Timedelta(hours=1)).to_numpy()
+    part_code = pd.factorize(cohort_df['part_id'])[0]
+    max_window = max([window for _, window, _ in rolling_metrics.values()], default=0)
+    key = part_code * (hours.max(initial=0) + max_window + 1) + hours
+
+    new_columns = {}
+    for metric, (environ_var, window, min_hours) in rolling_metrics.items():
+        if environ_var not in cohort_df.columns:
+            continue
+
+        # Index of the first row inside each row's window.
+        window_start = np.searchsorted(key, key - window, side='right')
+
+        # Window sums and counts are differences of the running totals at both ends of the window.
+        values = cohort_df[environ_var].to_numpy(dtype=float)
+        running_sum = np.r_[0, np.cumsum(np.nan_to_num(values))]
+        running_count = np.r_[0, np.cumsum(~np.isnan(values))]
+        row_end = np.arange(1, len(values) + 1)
+        window_sum = running_sum[row_end] - running_sum[window_start]
+        window_count = running_count[row_end] - running_count[window_start]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            new_columns[metric] = np.where(window_count >= min_hours, window_sum / window_count, np.nan)
+
+    cohort_df = cohort_df.assign(**new_columns)
+
+    return cohort_df
+
+def calculate_daily_maxima(cohort_df, environ_var_list):
+    """Calculates the daily maximum of each variable (including rolling metrics, e.g. the daily max 8-hour CO2) for
+    every participant, in one grouped reduction.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'GroupNO', 'time', and one column per sensor variable.
+        environ_var_list (list) : names of the variables (cohort table columns) to take daily maxima of.
+
+    Returns:
+        daily_maxima (df) : daily maxima indexed by ('part_id', 'date') with one column per variable.
+    """
+
+    date = cohort_df['time'].dt.floor('D').rename('date')
+    daily_maxima = cohort_df[environ_var_list].groupby([cohort_df['part_id'], date]).max()
+
+    return daily_maxima
+
+def calculate_daily_rollup(cohort_df, environ_var, part_ids, threshold=None):
+    """Rolls one variable up to a single value per participant and calendar day in one pass over the cohort table:
+    the daily mean, or the hours beyond a threshold. The input of graph_calendar_heatmap.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'time', and one column per sensor variable.
+        environ_var (str) : Name of current environmental variable.
+        part_ids (list) : participant IDs, in the order of the participant axis.
+        threshold (tuple) : (label, direction, threshold) from EXCEEDANCE_THRESHOLDS to count the hours beyond, or
+        None for the daily mean.
+
+    Returns:
+        days (DatetimeIndex) : every calendar day from the first to the last day with data.
+        daily (array) : (participant, day) array of the daily statistic, NaN on days without data.
+    """
+
+    values = cohort_df[environ_var].to_numpy(dtype=float)
+    part_code = pd.Categorical(cohort_df['part_id'], categories=part_ids).codes
+    valid = ~np.isnan(values) & (part_code >= 0)
+    if not valid.any():
+        return pd.DatetimeIndex([]), np.full((len(part_ids), 0), np.nan)
+
+    # Day of each valid row, counted from the first day with data.
+    day = cohort_df['time'].to_numpy('datetime64[ns]')[valid].astype('datetime64[D]')
+    first_day = day.min()
+    day_code = (day - first_day).astype(int)
+    shape = (len(part_ids), day_code.max() + 1)
+    flat_index = np.ravel_multi_index((part_code[valid], day_code), shape)
+
+    if threshold is None:
+        weights = values[valid]
+    else:
+        _, exceeded = flag_exceedances(cohort_df[[environ_var]][valid], [(environ_var, *threshold)])
+        weights = exceeded[:, 0]
+
+    hours = np.bincount(flat_index, minlength=np.prod(shape)).reshape(shape)
+    totals = np.bincount(flat_index, weights=weights, minlength=np.prod(shape)).reshape(shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        daily = np.where(hours > 0, totals / hours if threshold is None else totals, np.nan)
+
+    days = pd.date_range(pd.Timestamp(first_day), periods=shape[1], freq='D')
+
+    return days, daily
+
+def align_to_hour_grid(cohort_df, environ_var_list, part_ids, anchor=None):
+    """Projects every participant onto one shared hourly grid, from the first to the last hour of the cohort table, as
+    a dense (variable, participant, hour) array. Rows are placed by their hour with one scatter-add over the whole
+    table (rows sharing an hour are averaged), and hours without data are NaN. Cross-participant operations (group
+    means, envelopes, correlations) are then reductions along the participant or hour axis.
+
+    With an anchor visit, the grid is study-relative instead of calendar time: each participant's rows are placed by
+    the whole hours since their own anchor visit (see add_study_time), so position 0 is the first hour after every
+    participant's visit, e.g. the start of the intervention for '2B'.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'time', and one column per sensor variable, and the
+        'hours_since_{anchor}' column when anchor is given.
+        environ_var_list (list) : names of the environmental variables to align.
+        part_ids (list) : participant IDs, in the order of the participant axis.
+        anchor (str) : visit to align on (one of STUDY_TIME_ANCHORS), or None to align on calendar time.
+
+    Returns:
+        grid_hours (Index) : the hour of each position of the hour axis, as a DatetimeIndex for calendar time or whole
+        hours since the anchor visit.
+        aligned (array) : (variable, participant, hour) array of the hourly values, NaN for missing hours.
+    """
+
+    if anchor is None:
+        row_hour = cohort_df['time'].dt.floor('h')
+        first_hour = row_hour.min() if len(cohort_df) else pd.Timestamp(0)
+        grid_hours = pd.date_range(first_hour, row_hour.max() if len(cohort_df) else first_hour, freq='h')
+        hour_idx = ((row_hour - first_hour) // pd.Timedelta(hours=1)).to_numpy(dtype=int)
+    else:
+        row_hour = np.floor(cohort_df[f'hours_since_{anchor}'].to_numpy(dtype=float)).astype(int)
+        first_hour = row_hour.min(initial=0)
+        grid_hours = pd.RangeIndex(first_hour, row_hour.max(initial=0) + 1, name=f'hours_since_{anchor}')
+        hour_idx = row_hour - first_hour
+    shape = (len(part_ids), len(grid_hours))
+
+    part_code = pd.Categorical(cohort_df['part_id'], categories=part_ids).codes
+    known = part_code >= 0
+    flat_index = np.ravel_multi_index((part_code[known], hour_idx[known]), shape)
+
+    # Sum and count the values of each (participant, hour) cell, then divide; empty cells become NaN.
+    aligned = np.full((len(environ_var_list),) + shape, np.nan)
+    for i, environ_var in enumerate(environ_var_list):
+        values = cohort_df[environ_var].to_numpy(dtype=float)[known]
+        valid = ~np.isnan(values)
+        sums = np.bincount(flat_index[valid], weights=values[valid], minlength=np.prod(shape))
+        counts = np.bincount(flat_index[valid], minlength=np.prod(shape))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            aligned[i] = (sums / counts).reshape(shape)
+
+    return grid_hours, aligned
+
+def group_aligned_series(aligned, part_groups, percentiles=(10, 25, 50, 75, 90)):
+    """Reduces the aligned participant series to one hourly series per combined entry (all participants, and all
+    participants of each group): the mean, the percentiles across participants (the envelope), and the number of
+    participants with data.
+
+    Args:
+        aligned (array) : (variable, participant, hour) array from align_to_hour_grid (or bucket_aligned).
+        part_groups (Series) : GroupNO of each participant, in the order of the participant axis.
+        percentiles (tuple) : percentiles across participants to calculate.
+
+    Returns:
+        group_series (dict) : 'participants', 'mean', and '{percentile}th_percentile' for each percentile, each a
+        (variable, combined entry, hour) array with the combined entries in the order of DATA_GROUPS. Hours without any
+        data are NaN.
+    """
+
+    membership = combined_membership(part_groups)
+    shape = (aligned.shape[0], len(DATA_GROUPS), aligned.shape[2])
+    group_series = {'participants': np.zeros(shape, dtype=int), 'mean': np.full(shape, np.nan),
+                    **{f"{percentile}th_percentile": np.full(shape, np.nan) for percentile in percentiles}}
+
+    # One sort along the participant axis for each combined entry (NaN sorts last), then the mean and the percentiles
+    # (interpolated as in np.nanpercentile) are read off the sorted values of the participants with data.
+    for g, members in enumerate(membership):
+        if not members.any():
+            continue
+        member_values = np.sort(aligned[:, members], axis=1)
+        participants = (~np.isnan(member_values)).sum(axis=1)
+        group_series['participants'][:, g] = participants
+        with np.errstate(invalid='ignore', divide='ignore'):
+            group_series['mean'][:, g] = np.nansum(member_values, axis=1) / participants
+        for percentile in percentiles:
+            position = percentile / 100 * np.maximum(participants - 1, 0)
+            lower = np.floor(position).astype(int)
+            upper = np.minimum(lower + 1, np.maximum(participants - 1, 0))
+            lower_values = np.take_along_axis(member_values, lower[:, None], axis=1)[:, 0]
+            upper_values = np.take_along_axis(member_values, upper[:, None], axis=1)[:, 0]
+            group_series[f"{percentile}th_percentile"][:, g] = (lower_values + (upper_values - lower_values) *
+                                                                (position - lower))
+
+    return group_series
+
+def bucket_aligned(grid_hours, aligned, bucket_hours):
+    """Averages each participant's aligned hourly values over consecutive time buckets (e.g. 24 hours), so that
+    envelopes over months of data have a readable number of points. Buckets without any data are NaN.
+
+    Args:
+        grid_hours (Index) : the hour of each position of the hour axis, from align_to_hour_grid.
+        aligned (array) : (variable, participant, hour) array from align_to_hour_grid.
+        bucket_hours (int) : hours per bucket.
+
+    Returns:
+        bucket_times (Index) : the first hour of each bucket.
+        bucketed (array) : (variable, participant, bucket) array of the bucket means.
+    """
+
+    # Pad the hour axis with NaN to a whole number of buckets and reduce each bucket as its own axis.
+    n_buckets = -(-aligned.shape[2] // bucket_hours)
+    padded = np.full(aligned.shape[:2] + (n_buckets * bucket_hours,), np.nan)
+    padded[..., :aligned.shape[2]] = aligned
+    padded = padded.reshape(aligned.shape[:2] + (n_buckets, bucket_hours))
+
+    counts = (~np.isnan(padded)).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bucketed = np.nansum(padded, axis=-1) / counts
+    bucket_times = grid_hours[::bucket_hours]
+
+    return bucket_times, bucketed
+
+def pairwise_correlations(aligned_var, min_hours=24):
+    """Calculates the Pearson correlation between every pair of participants over the hours both have data, for all
+    pairs at once with a few matrix products over the aligned array.
+
+    Args:
+        aligned_var (array) : (participant, hour) array of one variable from align_to_hour_grid.
+        min_hours (int) : fewest shared hours for a correlation to be reported.
+
+    Returns:
+        correlations (array) : (participant, participant) array of correlations, NaN for pairs with fewer than
+        min_hours shared hours or no variation.
+    """
+
+    valid = ~np.isnan(aligned_var)
+    mask = valid.astype(float)
+    values = np.where(valid, aligned_var, 0.0)
+
+    # Sums over each pair's shared hours: n, sum(x), sum(x^2) over the hours where the other participant has data.
+    shared_hours = mask @ mask.T
+    sum_x = values @ mask.T
+    sum_xx = (values ** 2) @ mask.T
+    sum_xy = values @ values.T
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covariance = shared_hours * sum_xy - sum_x * sum_x.T
+        variance = shared_hours * sum_xx - sum_x ** 2
+        correlations = covariance / np.sqrt(variance * variance.T)
+
+    correlations[shared_hours < min_hours] = np.nan
+
+    return np.clip(correlations, -1, 1)
+
+def calculate_diurnal_profiles(cohort_df, participant_meta, environ_var_list):
+    """Calculates the hour-of-day x weekday profile (count, percentiles, max, mean, standard deviation) of every
+    variable for each participant, all participants combined, and all participants of each group combined, for each
+    study period and for the whole collection ('All'), along with the hour-of-day profile over all weekdays ('All').
+    Every cell is calculated exactly with calculate_summary_stats, one batched call per variable and combination of
+    period level (each period, 'All'), entity level (participant, overall, group), and weekday level (each weekday,
+    'All'), so that only one copy of one variable's values is held at a time.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'period', 'time', and one column per sensor variable.
+        participant_meta (df) : participant metadata indexed by 'part_id' with a 'GroupNO' column.
+        environ_var_list (list) : names of the environmental variables to calculate profiles for.
+
+    Returns:
+        profile_table (df) : profile statistics indexed by ('variable', 'period', 'entity', 'weekday', 'hour') with one
+        column per statistic. Weekdays are WEEKDAYS followed by 'All', entities are each participant followed by each
+        entry of DATA_GROUPS, periods are PERIODS followed by 'All'.
+    """
+
+    part_ids = list(participant_meta.index)
+    entities = part_ids + DATA_GROUPS
+    periods = PERIODS + ['All']
+    weekdays = WEEKDAYS + ['All']
+    shape = (len(environ_var_list), len(periods), len(entities), len(weekdays), 24)
+
+    # Each row counts for its participant, for all participants, and for its group.
+    part_code = pd.Categorical(cohort_df['part_id'], categories=part_ids).codes
+    group_code = len(part_ids) + 1 + pd.Categorical(cohort_df['GroupNO'], categories=['A', 'B', 'C']).codes
+    entity_codes = [part_code, np.full(len(cohort_df), len(part_ids)), np.where(group_code > len(part_ids),
+                                                                                 group_code, -1)]
+    period_codes = [cohort_df['period'].cat.codes.to_numpy(), np.full(len(cohort_df), len(PERIODS))]
+    weekday_codes = [cohort_df['time'].dt.weekday.to_numpy(), np.full(len(cohort_df), len(WEEKDAYS))]
+    hour = cohort_df['time'].dt.hour.to_numpy()
+
+    # The full (variable, period, entity, weekday, hour) layout of every statistic, NaN where there is no data.
+    stat_names = ['count', '10th_percentile', '25th_percentile', '50th_percentile', '75th_percentile',
+                  '90th_percentile', 'Maximum', 'Mean', 'Standard deviation']
+    columns = {stat: np.zeros(np.prod(shape), dtype=int) if stat == 'count' else np.full(np.prod(shape), np.nan)
+               for stat in stat_names}
+
+    # Sort each variable's column by value once, then summarize it for every period, entity, and weekday level in turn
+    # (keys within a level never overlap, so each call fills its own cells).
+    for v, environ_var in enumerate(environ_var_list):
+        values = cohort_df[environ_var].to_numpy(dtype=float)
+        order = np.argsort(values)
+        values = values[order]
+        has_value = ~np.isnan(values)
+        for period_code, entity_code, weekday_code in itertools.product(period_codes, entity_codes, weekday_codes):
+            valid = has_value & (period_code[order] >= 0) & (entity_code[order] >= 0)
+            rows = order[valid]
+            key = np.ravel_multi_index((np.full(len(rows), v), period_code[rows], entity_code[rows],
+                                        weekday_code[rows], hour[rows]), shape)
+            keys, profile_statistics = calculate_summary_stats(key, values[valid])
+            for stat, stat_values in profile_statistics.items():
+                columns[stat][keys] = stat_values
+
+    levels = [pd.CategoricalIndex(labels, categories=labels, ordered=True) for labels in
+              (environ_var_list, periods, entities, weekdays)] + [range(24)]
+    index = pd.MultiIndex.from_product(levels, names=['variable', 'period', 'entity', 'weekday', 'hour'])
+    profile_table = pd.DataFrame(columns, index=index)
+
+    return profile_table
+
+def load_diurnal_profiles(cohort_df, participant_meta, environ_var_list, cache_path):
+    """Returns the diurnal profiles from the cache file if it was built from the same cohort data, or calculates them
+    (calculate_diurnal_profiles) and saves them to the cache file.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'period', 'time', and one column per sensor variable.
+        participant_meta (df) : participant metadata indexed by 'part_id' with a 'GroupNO' column.
+        environ_var_list (list) : names of the environmental variables to calculate profiles for.
+        cache_path (str) : location of the profile cache file.
+
+    Returns:
+        profile_table (df) : profile statistics, see calculate_diurnal_profiles.
+    """
+
+    # The fingerprint covers every value the profiles are calculated from.
+    columns = ['part_id', 'GroupNO', 'period', 'time'] + environ_var_list
+    fingerprint = (tuple(environ_var_list), tuple(participant_meta.index),
+                   int(pd.util.hash_pandas_object(cohort_df[columns], index=False).sum()))
+
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as cache_file:
+            profile_cache = pickle.load(cache_file)
+        if profile_cache['fingerprint'] == fingerprint:
+            logging.info(f"Diurnal profiles loaded from {cache_path}.")
+            return profile_cache['profile_table']
+
+    profile_table = calculate_diurnal_profiles(cohort_df, participant_meta, environ_var_list)
+    with open(cache_path, 'wb') as cache_file:
+        pickle.dump({'fingerprint': fingerprint, 'profile_table': profile_table}, cache_file)
+
+    logging.info(f"Diurnal profiles successfully saved to {cache_path}.")
+
+    return profile_table
+
+def load_stats_state(state_path):
+    """Loads the summary statistics state saved by a previous run, if there is one.
+
+    Args:
+        state_path (str) : location of the saved state file.
+
+    Returns:
+        stats_state (dict) : the saved state (see update_stats_state), or None if nothing has been saved yet.
+    """
+
+    if not os.path.exists(state_path):
+        logging.info(f"No saved summary statistics state at {state_path}, all data will be added.")
+        return None
+
+    with open(state_path, 'rb') as state_file:
+        stats_state = pickle.load(state_file)
+
+    return stats_state
+
+def save_stats_state(stats_state, state_path):
+    # Save the summary statistics state so the next run only needs to add new hours.
+    with open(state_path, 'wb') as state_file:
+        pickle.dump(stats_state, state_file)
+
+    logging.info(f"Summary statistics state successfully saved to {state_path}.")
+
+    return state_path
+
+def update_stats_state(stats_state, cohort_df, participant_meta, environ_var_list, thresholds=EXCEEDANCE_THRESHOLDS):
+    """Adds the hours synced since the last update to the per-participant summary statistics state. The state keeps
+    every (participant, timestamp) already added, so only rows not seen before are added, including hours synced late
+    with timestamps before a participant's latest hour. Matching the rows against the seen hours is one hash lookup
+    per row; the statistics themselves cost time proportional to the new data.
+
+    The state holds, for every (variable, period, participant) with periods PERIODS followed by 'All': the count, sum,
+    sum of squares, maximum, and a quantile sketch (see build_quantile_sketches), plus the hours beyond each threshold
+    for every (threshold, period, participant). A participant whose visit dates 1 to 3B changed is cleared and added
+    again from all of their rows, and a participant no longer in participant_meta is removed from the state. The whole
+    state is rebuilt if environ_var_list or the thresholds changed.
+
+    Args:
+        stats_state (dict) : the state from the last update, or None to start from scratch.
+        cohort_df (df) : cohort table with 'part_id', 'period', 'time', and one column per sensor variable.
+        participant_meta (df) : participant metadata indexed by 'part_id' with 'GroupNO' and visit date columns.
+        environ_var_list (list) : names of the environmental variables to keep stats for.
+        thresholds (dict) : exceedance thresholds for each variable, see EXCEEDANCE_THRESHOLDS.
+
+    Returns:
+        stats_state (dict) : the updated state.
+    """
+
+    visit_cols = ['1', '2', '2B', '3', '3B']
+    n_periods, n_buckets = len(PERIODS) + 1, len(sketch_bucket_values())
+    threshold_list = list_thresholds(environ_var_list, thresholds)
+
+    if (stats_state is None or 'seen' not in stats_state or stats_state['environ_var_list'] != list(environ_var_list)
+            or stats_state['threshold_list'] != threshold_list):
+        stats_state = {
+            'environ_var_list': list(environ_var_list),
+            'threshold_list': threshold_list,
+            'part_ids': [],
+            'seen': pd.MultiIndex.from_arrays([[], pd.DatetimeIndex([])], names=['part_id', 'time']),
+            'visits': pd.DataFrame(columns=visit_cols),
+            'count': np.zeros((len(environ_var_list), n_periods, 0), dtype=int),
+            'sum': np.zeros((len(environ_var_list), n_periods, 0)),
+            'sum_sq': np.zeros((len(environ_var_list), n_periods, 0)),
+            'max': np.full((len(environ_var_list), n_periods, 0), np.nan),
+            'exceedances': np.zeros((len(threshold_list), n_periods, 0), dtype=int),
+            'sketches': np.zeros((len(environ_var_list), n_periods, 0, n_buckets), dtype=int),
+        }
+
+    # Remove participants no longer in the study, so they drop out of the participant and 'overall' entries.
+    kept = [i for i, part_id in enumerate(stats_state['part_ids']) if part_id in participant_meta.index]
+    if len(kept) < len(stats_state['part_ids']):
+        stats_state['part_ids'] = [stats_state['part_ids'][i] for i in kept]
+        for key in ['count', 'sum', 'sum_sq', 'max', 'exceedances', 'sketches']:
+            stats_state[key] = stats_state[key][:, :, kept]
+        stats_state['seen'] = stats_state['seen'][stats_state['seen'].get_level_values('part_id').isin(
+            stats_state['part_ids'])]
+
+    # Give any new participants an empty slot at the end of the participant axis.
+    new_ids = [part_id for part_id in participant_meta.index if part_id not in stats_state['part_ids']]
+    if new_ids:
+        stats_state['part_ids'] = stats_state['part_ids'] + new_ids
+        for key in ['count', 'sum', 'sum_sq', 'max', 'exceedances', 'sketches']:
+            empty_shape = list(stats_state[key].shape)
+            empty_shape[2] = len(new_ids)
+            empty = np.full(empty_shape, np.nan) if key == 'max' else np.zeros(empty_shape, stats_state[key].dtype)
+            stats_state[key] = np.concatenate([stats_state[key], empty], axis=2)
+
+    # Clear any participant whose periods moved, so all of their rows are added again under the new periods.
+    visits = participant_meta[visit_cols]
+    saved_visits = stats_state['visits'].reindex(visits.index)
+    changed = ~(visits == saved_visits).all(axis=1)
+    changed_idx = [stats_state['part_ids'].index(part_id) for part_id in visits.index[changed]]
+    for key in ['count', 'sum', 'sum_sq', 'exceedances', 'sketches']:
+        stats_state[key][:, :, changed_idx] = 0
+    stats_state['max'][:, :, changed_idx] = np.nan
+    stats_state['seen'] = stats_state['seen'][~stats_state['seen'].get_level_values('part_id').isin(
+        visits.index[changed])]
+    stats_state['visits'] = visits.copy()
+
+    # Only the (participant, timestamp) rows not added before are new.
+    row_keys = pd.MultiIndex.from_arrays([cohort_df['part_id'].astype(str), cohort_df['time']],
+                                         names=['part_id', 'time'])
+    is_new = ~row_keys.isin(stats_state['seen'])
+    new_rows = cohort_df[is_new]
+    if new_rows.empty:
+        return stats_state
+
+    shape = stats_state['count'].shape
+    values = new_rows[environ_var_list].to_numpy(dtype=float)
+    part_code = pd.Categorical(new_rows['part_id'], categories=stats_state['part_ids']).codes
+    period_code = new_rows['period'].cat.codes.to_numpy()
+    var_code = np.broadcast_to(np.arange(len(environ_var_list)), values.shape)
+
+    # Flat (variable, period, participant) index of every value in its own period (if it has one) and in 'All'.
+    valid = ~np.isnan(values)
+    in_period = valid & (period_code[:, None] >= 0)
+    flat_index = np.concatenate([
+        np.ravel_multi_index((var_code[in_period], np.broadcast_to(period_code[:, None], values.shape)[in_period],
+                              np.broadcast_to(part_code[:, None], values.shape)[in_period]), shape),
+        np.ravel_multi_index((var_code[valid], np.full(valid.sum(), len(PERIODS)),
+                              np.broadcast_to(part_code[:, None], values.shape)[valid]), shape),
+    ])
+    flat_values = np.concatenate([values[in_period], values[valid]])
+
+    size = np.prod(shape)
+    stats_state['count'] += np.bincount(flat_index, minlength=size).reshape(shape)
+    stats_state['sum'] += np.bincount(flat_index, weights=flat_values, minlength=size).reshape(shape)
+    stats_state['sum_sq'] += np.bincount(flat_index, weights=flat_values ** 2, minlength=size).reshape(shape)
+    np.fmax.at(stats_state['max'].reshape(-1), flat_index, flat_values)
+    stats_state['sketches'] += build_quantile_sketches(new_rows, environ_var_list, stats_state['part_ids'])
+    stats_state['exceedances'] += count_exceedances(new_rows, threshold_list, stats_state['part_ids'])[0]
+
+    # Remember the added hours.
+    stats_state['seen'] = stats_state['seen'].append(row_keys[is_new])
+
+    return stats_state
+
+def summary_table_from_state(stats_state, participant_meta):
+    """Builds the summary table (same layout as prep_summary_stats) from the summary statistics state, without reading
+    any samples. Participant percentiles come from their quantile sketches, so they have the same error bound as the
+    combined entries (see build_quantile_sketches).
+
+    Args:
+        stats_state (dict) : the state from update_stats_state.
+        participant_meta (df) : participant metadata indexed by 'part_id' with a 'GroupNO' column.
+
+    Returns:
+        summary_table (df) : summary statistics indexed by ('variable', 'period', 'entity') with one column per
+        statistic.
+    """
+
+    count = stats_state['count']
+    quantiles = sketch_quantiles(stats_state['sketches'], [0.10, 0.25, 0.50, 0.75, 0.90])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = stats_state['sum'] / count
+        participant_stats = {
+            "count": count,
+            **{f"{percentile}th_percentile": quantiles[..., i] for i, percentile in enumerate([10, 25, 50, 75, 90])},
+            "Maximum": stats_state['max'],
+            "Mean": mean,
+            "Standard deviation": np.sqrt(np.maximum(stats_state['sum_sq'] / count - mean ** 2, 0)),
+        }
+
+    part_groups = participant_meta['GroupNO'].reindex(stats_state['part_ids'])
+    environ_var_list, threshold_list = stats_state['environ_var_list'], stats_state['threshold_list']
+    summary_table = assemble_summary_table(participant_stats, stats_state['sketches'], part_groups, environ_var_list)
+
+    # The hours with a value for each threshold's variable are that variable's counts.
+    hours = count[[environ_var_list.index(environ_var) for environ_var, _, _, _ in threshold_list]]
+    exceedance_table = exceedance_table_from_counts(stats_state['exceedances'], hours, threshold_list, part_groups,
+                                                    environ_var_list)
+    summary_table = add_exceedance_columns(summary_table, exceedance_table)
+
+    return summary_table
+
+def group_lists(participant_meta):
+    """Creates 3 lists, one for each educational group, to sort all participant IDs into their respective groups.
+
+    Args:
+        participant_meta (df) : participant metadata indexed by 'part_id' with a 'GroupNO' column.
+
+    Returns:
+        educational_groups (dict) : dictionary containing 3 lists. Each list contains all participant IDs from that
+        educational group.
+    """
+
+    # Initializes dictionary to contain the IDs of all participants in each educational group.
+    educational_groups = {'A': [], 'B': [], 'C': []}
+
+    # Records participant ID into one of the 3 educational group lists.
+    for group, part_ids in participant_meta.groupby('GroupNO').groups.items():
+        if group in educational_groups:
+            educational_groups[group] = list(part_ids)
+
+    return educational_groups
+
+def group_timeseries_jobs(cohort_df, educational_groups, environ_var, graph_location, group_envelope=None):
+    """Lists the render jobs of the timeseries graphs of environ_var for all participants of each educational group:
+    one graph per group with a line per participant (3 graphs).
+
+    In envelope mode (group_envelope given) a single graph shows each group as its median line with 25-75 and 10-90
+    percentile bands across participants, precomputed per time bucket, so the graph stays readable and quick to draw
+    however many participants there are.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'time', and one column per sensor variable.
+        educational_groups (dict) : dictionary containing 3 lists. Each list contains all participant IDs from that
+        educational group.
+        environ_var (str) : Name of current environmental variable.
+        graph_location (str) : pathway to where graphs are saved
+        group_envelope (tuple) : (bucket_times, group_series) with group_series the (combined entry, bucket) arrays of
+        environ_var from group_aligned_series, or None to graph one line per participant.
+
+    Returns:
+        render_jobs (list) : (graphing function, args) for every timeseries graph.
+    """
+
+    if group_envelope is not None:
+        return [(graph_group_envelopes, (*group_envelope, environ_var, graph_location))]
+
+    # Create one graph for each educational group
+    render_jobs = []
+    for ed_group in ['A', 'B', 'C']:
+        participant_series = group_participant_series(cohort_df, educational_groups[ed_group], environ_var)
+        render_jobs.append((graph_participant_lines, (participant_series, ed_group, environ_var, graph_location)))
+
+    return render_jobs
+
+def group_participant_series(cohort_df, participants, environ_var, max_points=TIMESERIES_POINT_BUDGET):
+    """Pulls out the timeseries of one variable for each of the given participants as plain arrays, the compact input of
+    graph_participant_lines. Each series is downsampled to at most max_points points (see downsample_min_max).
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'time', and one column per sensor variable.
+        participants (list) : participant IDs to include.
+        environ_var (str) : Name of current environmental variable.
+        max_points (int) : most points kept per participant, or None to keep every hour.
+
+    Returns:
+        participant_series (dict) : part_id : (times, values) arrays for each participant, in the order given.
+    """
+
+    rows = cohort_df.loc[cohort_df['part_id'].isin(participants), ['part_id', 'time', environ_var]]
+    grouped = dict(tuple(rows.groupby('part_id', sort=False)))
+    participant_series = {part_id: (grouped[part_id]['time'].to_numpy(), grouped[part_id][environ_var].to_numpy())
+                          for part_id in participants if part_id in grouped}
+
+    if max_points is not None:
+        participant_series = {part_id: downsample_min_max(times, values, max_points) for part_id, (times, values) in
+                              participant_series.items()}
+
+    return participant_series
+
+def downsample_min_max(times, values, max_points):
+    """Downsamples a timeseries for plotting by splitting its time span into max_points / 2 equal buckets (about one
+    per pixel column) and keeping the lowest and highest value of each bucket, in time order. Every peak and dip stays
+    in the graph, while the number of points drawn stays the same however long the series is. Missing values are
+    dropped.
+
+    Args:
+        times (array) : timestamps of the series, in ascending order.
+        values (array) : values of the series.
+        max_points (int) : most points to keep.
+
+    Returns:
+        times (array) : timestamps of the kept points.
+        values (array) : values of the kept points.
+    """
+
+    valid = ~np.isnan(values)
+    times, values = times[valid], values[valid]
+    if len(values) <= max_points:
+        return times, values
+
+    # Bucket of every point by its position in the time span.
+    n_buckets = max(max_points // 2, 1)
+    elapsed = (times - times[0]).astype('timedelta64[ns]').astype(np.int64)
+    bucket = np.minimum(elapsed * n_buckets // max(elapsed[-1], 1), n_buckets - 1)
+
+    # Sort by bucket then value: each bucket's first and last entries are its min and max.
+    order = np.lexsort((values, bucket))
+    starts = np.flatnonzero(np.diff(bucket[order], prepend=-1))
+    ends = np.r_[starts[1:], len(order)] - 1
+    keep = np.unique(np.concatenate([order[starts], order[ends]]))
+
+    return times[keep], values[keep]
+
+def graph_participant_lines(participant_series, ed_group, environ_var, graph_location):
+    """Graphs one timeseries line per participant of one educational group.
+
+    Args:
+        participant_series (dict) : part_id : (times, values) arrays from group_participant_series.
+        ed_group (str) : the educational group (A, B, or C).
+        environ_var (str) : Name of current environmental variable.
+        graph_location (str) : pathway to where graphs are saved
+
+    Returns:
+        file_path (str) : location of the saved graph.
+    """
+
+    fig, ax = plt.subplots(figsize=(8, 5), dpi=150)
+    title = f'{environ_var} vs Time, Group {ed_group}'
+    ax.set_title(title, fontdict={'fontweight': 'bold', 'fontsize': 18})
+    ax.set_xlabel('Timestamp', fontdict={'fontweight': 'bold', 'fontsize': 14})
+    ax.set_ylabel(f'{environ_var}', fontdict={'fontweight': 'bold', 'fontsize': 14})
+
+    # Go through all participants of the current educational group, plotting PM2.5 vs time.
+    for i, (part_id, (times, values)) in enumerate(participant_series.items()):
+        # Plot PM2.5 vs time using the color, line style, and marker of the current participant.
+        ax.plot(times, values, **participant_line_style(i), linewidth=1, markersize=2, label=part_id)
+
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.legend()
+
+    # Save the plot to the specified directory
+    return save_graph(fig, graph_location, title.replace(' ', '_'))
+
+def graph_group_envelopes(bucket_times, group_series, environ_var, graph_location):
+    """Graphs the median and the 25-75 and 10-90 percentile bands across participants of each educational group over
+    time, one line and two bands per group.
+
+    Args:
+        bucket_times (Index) : the time of each bucket.
+        group_series (dict) : '{percentile}th_percentile' (combined entry, bucket) arrays of one variable from
+        group_aligned_series, with the combined entries in the order of DATA_GROUPS.
+        environ_var (str) : Name of current environmental variable.
+        graph_location (str) : pathway to where graphs are saved
+    """
+
+    colors = [group_colors()[ed_group] for ed_group in ['A', 'B', 'C']]
+
+    fig, ax = plt.subplots(figsize=(8, 5), dpi=150)
+    title = f'{environ_var} vs Time, Group Envelopes'
+    ax.set_title(title, fontdict={'fontweight': 'bold', 'fontsize': 18})
+    ax.set_xlabel('Timestamp', fontdict={'fontweight': 'bold', 'fontsize': 14})
+    ax.set_ylabel(f'{environ_var}', fontdict={'fontweight': 'bold', 'fontsize': 14})
+
+    for g, (data_group, color) in enumerate(zip(DATA_GROUPS[1:], colors), start=1):
+        ax.fill_between(bucket_times, group_series['10th_percentile'][g], group_series['90th_percentile'][g],
+                        color=color, alpha=0.2, linewidth=0)
+        ax.fill_between(bucket_times, group_series['25th_percentile'][g], group_series['75th_percentile'][g],
+                        color=color, alpha=0.4, linewidth=0)
+        ax.plot(bucket_times, group_series['50th_percentile'][g], color=color, linewidth=1.5,
+                label=f'Group {data_group[-1]}')
+
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.legend()
+
+    # Save the plot to the specified directory
+    return save_graph(fig, graph_location, title.replace(' ', '_').replace(',', ''))
+
+def build_render_jobs(cohort_df, participant_meta, summary_table, profile_table, group_envelopes, educational_groups,
+                      legend_elements, environ_var_list, graph_location, summary_grid=False):
+    """Lists every graph of the variable sweep (variable x graph type x group) as an independent job. Each job carries
+    only the compact data its graph needs (a group's arrays, a slice of a summary table), never the cohort table, so it
+    can be sent to a worker process cheaply.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'time', and one column per sensor variable.
+        participant_meta (df) : participant metadata indexed by 'part_id' with a 'color' column.
+        summary_table (df) : summary statistics indexed by ('variable', 'period', 'entity').
+        profile_table (df) : profile statistics from calculate_diurnal_profiles.
+        group_envelopes (dict) : environ_var : (bucket_times, group_series) for the envelope graphs, or None to graph
+        one line per participant.
+        educational_groups (dict) : dictionary containing 3 lists of participant IDs, one per educational group.
+        legend_elements (list) : defines color coding for legend.
+        environ_var_list (list) : names of the environmental variables to graph.
+        graph_location (str) : pathway to where graphs are saved.
+        summary_grid (bool) : True to graph the summary statistics of every variable in one grid (plot_summary_grid)
+        instead of one bar chart per variable and statistic (plot_summaries).
+
+    Returns:
+        render_jobs (list) : (graphing function, args) for every graph.
+    """
+
+    render_jobs = []
+    for environ_var in environ_var_list:
+        group_envelope = group_envelopes[environ_var] if group_envelopes is not None else None
+        render_jobs += group_timeseries_jobs(cohort_df, educational_groups, environ_var, graph_location, group_envelope)
+
+        summary_stats = summary_table.loc[(environ_var, 'All')]
+        if not summary_grid:
+            render_jobs.append((plot_summaries, (summary_stats, participant_meta[['color']], legend_elements,
+                                                 environ_var, graph_location)))
+        render_jobs.append((plot_diurnal_profiles, (profile_table.loc[[environ_var]], environ_var, graph_location)))
+
+        render_jobs.append((plot_box_whisker, (summary_stats, participant_meta[['color']], legend_elements,
+                                               environ_var, graph_location)))
+
+        # Calendar heatmaps of the daily mean and of the daily hours beyond the variable's first threshold.
+        part_ids = list(participant_meta.index)
+        calendar_stats = [('Daily Mean', None)] + [(label.replace('Percent', 'Hours'), (label, direction, value))
+                                                   for label, direction, value in
+                                                   EXCEEDANCE_THRESHOLDS.get(environ_var, [])[:1]]
+        for stat_label, threshold in calendar_stats:
+            days, daily = calculate_daily_rollup(cohort_df, environ_var, part_ids, threshold)
+            render_jobs.append((graph_calendar_heatmap, (days, daily, part_ids, stat_label, environ_var,
+                                                         graph_location)))
+
+    if summary_grid:
+        grid_stats = summary_table.xs('All', level='period').loc[environ_var_list]
+        render_jobs.append((plot_summary_grid, (grid_stats, participant_meta[['color']], legend_elements,
+                                                environ_var_list, graph_location)))
+
+    return render_jobs
+
+def render_charts(render_jobs, workers=None, manifest_path=None):
+    """Renders every graph job from build_render_jobs, spread over a pool of worker processes. Each job draws and
+    saves its own figures, so the jobs share nothing and the time scales down with the number of cores.
+
+    With a manifest, every job is fingerprinted (fingerprint_render_job) and skipped if the manifest lists the same
+    fingerprint with all of its graphs still on disk, so a refresh only re-renders the graphs whose data, style, or
+    code changed. The manifest is rewritten with the fingerprints of this run's jobs.
+
+    Args:
+        render_jobs (list) : (graphing function, args) for every graph.
+        workers (int) : number of worker processes, or None to render the jobs in order in this process.
+        manifest_path (str) : location of the render manifest (a JSON file of fingerprint : graph files), or None to
+        render every job.
+
+    Returns:
+        file_paths (list) : the graph files of each job, in job order.
+    """
+
+    start_time = datetime.now()
+
+    manifest = {}
+    if manifest_path is not None and os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+    # Only the jobs without a matching fingerprint and complete outputs are rendered.
+    fingerprints = [fingerprint_render_job(graph_function, args) for graph_function, args in render_jobs]
+    file_paths = [manifest.get(fingerprint) for fingerprint in fingerprints]
+    to_render = [i for i, paths in enumerate(file_paths) if manifest_path is None or paths is None or
+                 not all(os.path.exists(path) for path in paths)]
+
+    if workers and to_render:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {i: executor.submit(render_jobs[i][0], *render_jobs[i][1]) for i in to_render}
+            results = {i: future.result() for i, future in futures.items()}
+    else:
+        results = {i: render_jobs[i][0](*render_jobs[i][1]) for i in to_render}
+
+    for i, result in results.items():
+        file_paths[i] = [result] if isinstance(result, str) else list(result)
+
+    if manifest_path is not None:
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(dict(zip(fingerprints, file_paths)), manifest_file, indent=1)
+
+    logging.info(f"Rendered {len(to_render)} of {len(render_jobs)} graph jobs in "
+                 f"{(datetime.now() - start_time).total_seconds():.1f} s, the rest were unchanged.")
+
+    return file_paths
+
+def fingerprint_render_job(graph_function, args):
+    """Fingerprints a graph job from everything that decides its output: the code of the graphing function and of
+    every function of this module it draws with (update_code_fingerprint), RENDER_STYLE_VERSION, and the content of
+    every argument.
+
+    Args:
+        graph_function (function) : the graphing function of the job.
+        args (tuple) : the arguments of the job.
+
+    Returns:
+        fingerprint (str) : hex digest of the job.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(f'{graph_function.__name__}:{RENDER_STYLE_VERSION}'.encode())
+    update_code_fingerprint(digest, graph_function)
+    update_fingerprint(digest, args)
+
+    return digest.hexdigest()
+
+def update_code_fingerprint(digest, graph_function):
+    """Adds the code of a graphing function to a fingerprint, so that editing it re-renders its graphs. Follows the
+    global names in the code to every function of this module it calls, directly or through other functions, and adds
+    each one's bytecode, constants (colors, sizes, labels, ...) and names, including those of nested code such as
+    comprehensions. The module constants the code refers to (e.g. PERIODS) are added by value.
+
+    Args:
+        digest (hash) : hashlib object to update.
+        graph_function (function) : the graphing function of the job.
+    """
+
+    module_globals = globals()
+    functions = {graph_function.__name__: graph_function}
+    constants = {}
+    pending = [graph_function.__code__]
+    while pending:
+        code = pending.pop()
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode())
+        for constant in code.co_consts:
+            if isinstance(constant, types.CodeType):
+                pending.append(constant)
+            else:
+                digest.update(repr(constant).encode())
+
+        # Functions of this module (unwrapping lru_cache) are followed, other module-level values are constants.
+        for name in code.co_names:
+            if name not in module_globals or name in functions or name in constants:
+                continue
+            value = getattr(module_globals[name], '__wrapped__', module_globals[name])
+            if inspect.isfunction(value):
+                if value.__module__ == graph_function.__module__:
+                    functions[name] = value
+                    pending.append(value.__code__)
+            elif not (inspect.ismodule(value) or inspect.isclass(value) or callable(value)):
+                constants[name] = value
+
+    for name in sorted(constants):
+        digest.update(name.encode())
+        update_fingerprint(digest, constants[name])
+
+    return
+
+def update_fingerprint(digest, value):
+    """Adds the content of a graph job argument to a fingerprint: tables and arrays by their values, legend patches by
+    their label and color, containers item by item, and anything else by its repr.
+
+    Args:
+        digest (hash) : hashlib object to update.
+        value : the argument to add.
+    """
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        digest.update(repr(list(value.columns) if isinstance(value, pd.DataFrame) else value.name).encode())
+    elif isinstance(value, pd.Index):
+        digest.update(pd.util.hash_pandas_object(value.to_series(), index=False).to_numpy().tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.dtype, value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes() if value.dtype != object else repr(value.tolist()).encode())
+    elif isinstance(value, Patch):
+        digest.update(repr((value.get_label(), value.get_facecolor())).encode())
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            update_fingerprint(digest, key)
+            update_fingerprint(digest, item)
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            update_fingerprint(digest, item)
+    else:
+        digest.update(repr(value).encode())
+
+    return
+
+def save_graph(fig, graph_location, file_name):
+    # Save the figure to the specified directory (trimmed to its contents so that rotated tick labels are not cut off),
+    # then close it so that a full sweep of graphs keeps memory flat.
+    file_path = os.path.join(graph_location, f'{file_name}.png')
+    fig.savefig(file_path, bbox_inches='tight')
+    plt.close(fig)
+
+    return file_path
+
+def save_table(table, graph_location, file_name):
+    # Save a results table (summary statistics, exceedance episodes, ...) to a csv file.
+    output_path = os.path.join(graph_location, file_name)
+    table.to_csv(output_path, index=True)
+
+    logging.info(f"{file_name} successfully saved to {output_path}.")
+
+    return output_path
+
+def plot_summaries(summary_stats, participant_meta, legend_elements, environ_var, graph_location):
+    """Creates a bar chart of the summary statistics ('max', 'mean', and the percentage beyond each exceedance
+    threshold of environ_var). Each chart includes each individual participant, all participants, all Group A, all
+    group B, and all group C. Bars are color-coded by group assignment.
+    Args:
+        summary_stats (df) : summary statistics for environ_var with one row per participant and combined entry.
+        participant_meta (df) : participant metadata indexed by 'part_id' with a 'color' column.
+        legend_elements (list) : defines color coding for legend.
+        environ_var (str) : Name of current environmental variable.
+        graph_location (str) : pathway to where graphs are saved.
+
+    Returns:
+        file_paths (list) : locations of the saved graphs.
+    """
+
+    participant_ids = list(summary_stats.index)
+
+    # Create list of summary stats to be graphed via bar: max, mean, and every exceedance threshold of this variable.
+    exceedance_labels = [label for label in summary_stats.columns if label.startswith('Percent')]
+    stats_to_graph = ['Maximum', 'Mean'] + [label for label in exceedance_labels if summary_stats[label].notna().any()]
+
+    # Retrieve the colors for each participant, the combined entries get the overall color.
+    overall_color = group_colors()['Overall']
+    colors = [participant_meta['color'].get(part_id, overall_color) for part_id in participant_ids]
+
+    # Create a bar chart for each summary statistic.
+    file_paths = []
+    for sum_stat in stats_to_graph:
+        fig, ax = plt.subplots(figsize=(8, 5), dpi=150)
+        title = f'{environ_var} {sum_stat} vs Participant'
+        ax.set_title(title, fontdict={'fontweight': 'bold', 'fontsize': 18})
+        ax.set_xlabel('Participant')
+        ax.set_ylabel(sum_stat)
+
+        # Retrieve the summary statistic values for each participant, create the bar plot with assigned colors
+        ax.bar(participant_ids, summary_stats[sum_stat], color=colors)
+
+        ax.legend(handles=legend_elements)
+        ax.tick_params(axis='x', labelrotation=45)
+
+        # Save the plot to the specified directory
+        file_paths.append(save_graph(fig, graph_location, title.replace(' ', '_')))
+
+    return file_paths
+
+def plot_summary_grid(summary_table, participant_meta, legend_elements, environ_var_list, graph_location):
+    """Creates one small-multiples figure of the statistics plot_summaries graphs separately: a row per variable and a
+    column per statistic (max, mean, and each exceedance threshold of the variable), with the participants on a shared
+    x axis, max and mean on a shared y axis within each row, and a single legend.
+
+    Args:
+        summary_table (df) : summary statistics indexed by ('variable', 'entity'), for the whole collection.
+        participant_meta (df) : participant metadata indexed by 'part_id' with a 'color' column.
+        legend_elements (list) : defines color coding for legend.
+        environ_var_list (list) : names of the environmental variables to graph, one per row.
+        graph_location (str) : pathway to where graphs are saved.
+
+    Returns:
+        file_path (str) : location of the saved graph.
+    """
+
+    # Statistics of each row: max, mean, and every exceedance threshold with data for that variable.
+    exceedance_labels = [label for label in summary_table.columns if label.startswith('Percent')]
+    row_stats = {environ_var: ['Maximum', 'Mean'] + [label for label in exceedance_labels if
+                                                     summary_table.loc[environ_var, label].notna().any()]
+                 for environ_var in environ_var_list}
+    n_cols = max(len(stats) for stats in row_stats.values())
+
+    participant_ids = list(summary_table.loc[environ_var_list[0]].index)
+    overall_color = group_colors()['Overall']
+    colors = [participant_meta['color'].get(part_id, overall_color) for part_id in participant_ids]
+
+    fig_height = 2.2 * len(environ_var_list) + 0.5
+    fig, axes = plt.subplots(len(environ_var_list), n_cols, figsize=(3 * n_cols, fig_height), dpi=100, sharex=True,
+                             squeeze=False)
+    for row, environ_var in enumerate(environ_var_list):
+        summary_stats = summary_table.loc[environ_var].reindex(participant_ids)
+        for col in range(n_cols):
+            ax = axes[row, col]
+            if col >= len(row_stats[environ_var]):
+                ax.axis('off')
+                continue
+
+            sum_stat = row_stats[environ_var][col]
+            ax.bar(participant_ids, summary_stats[sum_stat], color=colors)
+            ax.set_title(f'{environ_var} {sum_stat}', fontdict={'fontsize': 9})
+            ax.tick_params(axis='both', labelsize=7)
+            ax.tick_params(axis='x', labelrotation=90)
+            if sum_stat == 'Mean':
+                ax.sharey(axes[row, 0])
+
+    # Label the participants under the lowest panel of each column.
+    for col in range(n_cols):
+        lowest_row = max(row for row, environ_var in enumerate(environ_var_list) if col < len(row_stats[environ_var]))
+        axes[lowest_row, col].tick_params(axis='x', labelbottom=True)
+
+    # Fixed spacing rather than tight_layout, which measures every tick label of every panel and would cost more than
+    # drawing the grid.
+    fig.legend(handles=legend_elements, loc='upper center', ncol=len(legend_elements), bbox_to_anchor=(0.5, 1.0))
+    fig.subplots_adjust(top=1 - 0.7 / fig_height, hspace=0.45, wspace=0.3)
+
+    # Save the plot to the specified directory
+    return save_graph(fig, graph_location, 'Summary_Statistics_Grid')
+
+def plot_diurnal_profiles(profile_table, environ_var, graph_location, period='All'):
+    """Creates a weekday x hour-of-day heatmap of the mean of environ_var for all participants and for each group, and
+    a graph of the median and interquartile range by hour of day, both drawn from the precomputed profile cells rather
+    than the raw series.
+
+    Args:
+        profile_table (df) : profile statistics from calculate_diurnal_profiles.
+        environ_var (str) : Name of current environmental variable.
+        graph_location (str) : pathway to where graphs are saved.
+        period (str) : study period to graph (one of PERIODS, or 'All').
+
+    Returns:
+        file_paths (list) : locations of the saved graphs.
+    """
+
+    profiles = profile_table.loc[(environ_var, period)]
+
+    # One heatmap per combined entry, all on the same color scale.
+    means = profiles.loc[(DATA_GROUPS, WEEKDAYS), 'Mean'].to_numpy().reshape(len(DATA_GROUPS), len(WEEKDAYS), 24)
+    fig, axes = plt.subplots(len(DATA_GROUPS), 1, figsize=(8, 10), dpi=150, sharex=True)
+    title = f'{environ_var} Weekly Profile, {period}'
+    fig.suptitle(title, fontweight='bold', fontsize=18)
+    for ax, data_group, mean in zip(axes, DATA_GROUPS, means):
+        image = ax.imshow(mean, aspect='auto', cmap='viridis', vmin=np.nanmin(means), vmax=np.nanmax(means))
+        ax.set_title(data_group)
+        ax.set_yticks(range(len(WEEKDAYS)), WEEKDAYS)
+    axes[-1].set_xlabel('Hour of Day', fontdict={'fontweight': 'bold', 'fontsize': 14})
+    fig.colorbar(image, ax=axes, label=f'Mean {environ_var}')
+
+    # Save the plot to the specified directory
+    file_paths = [save_graph(fig, graph_location, title.replace(' ', '_').replace(',', ''))]
+
+    fig, ax = plt.subplots(figsize=(8, 5), dpi=150)
+    title = f'{environ_var} Daily Profile, {period}'
+    ax.set_title(title, fontdict={'fontweight': 'bold', 'fontsize': 18})
+    ax.set_xlabel('Hour of Day', fontdict={'fontweight': 'bold', 'fontsize': 14})
+    ax.set_ylabel(f'{environ_var}', fontdict={'fontweight': 'bold', 'fontsize': 14})
+
+    # Median line and interquartile band from the hour-of-day profile over all weekdays.
+    colors = list(group_colors().values())
+    daily = profiles.xs('All', level='weekday')
+    # Overall last so that it is drawn on top of the groups.
+    for data_group, color in zip(DATA_GROUPS[1:] + DATA_GROUPS[:1], colors):
+        profile = daily.loc[data_group]
+        ax.plot(profile.index, profile['50th_percentile'], color=color, linewidth=2, label=data_group)
+        ax.fill_between(profile.index, profile['25th_percentile'], profile['75th_percentile'], color=color, alpha=0.2)
+
+    ax.set_xticks(range(0, 24, 3))
+    ax.legend()
+
+    # Save the plot to the specified directory
+    file_paths.append(save_graph(fig, graph_location, title.replace(' ', '_').replace(',', '')))
+
+    return file_paths
+
+def plot_box_whisker(summary_stats, participant_meta, legend_elements, environ_var, graph_location):
+    """Creates a box and whisker plot of environ_var for each participant, all participants, and all participants of
+    each group, drawn from the percentiles of the summary statistics rather than the raw samples, so the boxes match
+    the exported summary table: the box spans the 25th to 75th percentile and the whiskers the 10th to 90th.
+    Args:
+        summary_stats (df) : summary statistics for environ_var with one row per participant and combined entry.
+        participant_meta (df) : participant metadata indexed by 'part_id' with a 'color' column.
+        legend_elements (list) : defines color coding for legend.
+        environ_var (str) : Name of current environmental variable.
+        graph_location (str) : pathway to where graphs are saved.
+
+    Returns:
+        file_path (str) : location of the saved graph.
+    """
+
+    box_stats = summary_box_stats(summary_stats)
+
+    # Retrieve the colors for each participant, the combined entries get the overall color.
+    overall_color = group_colors()['Overall']
+    colors = [participant_meta['color'].get(stats['label'], overall_color) for stats in box_stats]
+
+    return graph_box_whisker(box_stats, colors, legend_elements, environ_var, graph_location)
+
+def summary_box_stats(summary_stats):
+    """Turns summary statistics into the box statistics taken by matplotlib's bxp, one box per entry with data.
+
+    Args:
+        summary_stats (df) : summary statistics with one row per participant and combined entry.
+
+    Returns:
+        box_stats (list) : dicts with 'label', 'whislo' (10th percentile), 'q1', 'med', 'q3', 'whishi' (90th
+        percentile), and 'mean' for each entry with data.
+    """
+
+    with_data = summary_stats[summary_stats['count'] > 0]
+    box_stats = [{'label': entity, 'whislo': row['10th_percentile'], 'q1': row['25th_percentile'],
+                  'med': row['50th_percentile'], 'q3': row['75th_percentile'], 'whishi': row['90th_percentile'],
+                  'mean': row['Mean']} for entity, row in with_data.iterrows()]
+
+    return box_stats
+
+def graph_box_whisker(box_stats, colors, legend_elements, environ_var, graph_location):
+    """Draws the box and whisker plot of plot_box_whisker from precomputed box statistics.
+
+    Args:
+        box_stats (list) : box statistics from summary_box_stats.
+        colors (list) : color of each box, in the order of box_stats.
+        legend_elements (list) : defines color coding for legend.
+        environ_var (str) : Name of current environmental variable.
+        graph_location (str) : pathway to where graphs are saved.
+
+    Returns:
+        file_path (str) : location of the saved graph.
+    """
+
+    # Create a box and whisker plot with every entry
+    fig, ax = plt.subplots(figsize=(8, 5), dpi=150)
+    bp = ax.bxp(box_stats, patch_artist=True, showfliers=False)
+
+    ax.tick_params(axis='x', labelrotation=45)
+
+    # Set the facecolor of each box based on participant's color.
+    for box, color in zip(bp['boxes'], colors):
+        box.set_facecolor(color)
+
+    # Set the color of median line to black
+    for median in bp['medians']:
+        median.set(color='black')
+
+    # Set labels and title
+    ax.set_xlabel('Participant', fontdict={'fontweight': 'bold', 'fontsize': 14})
+    ax.set_ylabel(environ_var, fontdict={'fontweight': 'bold', 'fontsize': 14})
+    title = f'{environ_var} vs Participant Data Distribution'
+    ax.set_title(title, fontdict={'fontweight': 'bold', 'fontsize': 18})
+    ax.legend(handles=legend_elements)
+
+    # Save the plot to the specified directory
+    return save_graph(fig, graph_location, title.replace(' ', '_'))
+
+def build_report_jobs(cohort_df, participant_meta, summary_table, effect_table, legend_elements, environ_var_list,
+                      report_location):
+    """Prepares the report-back documents. The assets every report shares are made once here: the stylesheet, the
+    graph legend, and the cohort reference values (mean and median of all participants and of each group in each
+    period). Each participant then gets a job with only their own stats, period changes, and downsampled series.
+
+    Args:
+        cohort_df (df) : cohort table with 'part_id', 'time', and one column per sensor variable.
+        participant_meta (df) : participant metadata indexed by 'part_id' with 'GroupNO', 'color', and visit columns.
+        summary_table (df) : summary statistics indexed by ('variable', 'period', 'entity').
+        effect_table (df) : effect table from calculate_effect_table.
+        legend_elements (list) : defines color coding for legend.
+        environ_var_list (list) : names of the environmental variables to report.
+        report_location (str) : pathway to where the reports are saved.
+
+    Returns:
+        shared_assets (dict) : 'style' and 'legend' file names and the 'reference' table.
+        report_jobs (list) : (part_id, report_data) for every participant, report_data holding the participant's
+        'group', 'color', 'visits', 'stats', 'effects', and 'series'.
+    """
+
+    os.makedirs(report_location, exist_ok=True)
+
+    style_path = os.path.join(report_location, 'report.css')
+    with open(style_path, 'w') as style_file:
+        style_file.write(REPORT_STYLE)
+
+    # One legend for every report graph: the group colors plus the line styles of the hourly values and period means.
+    line_elements = [Line2D([], [], color='black', linestyle='-', label='Hourly values'),
+                     Line2D([], [], color='black', linestyle='--', label='Period mean')]
+    fig, ax = plt.subplots(figsize=(8, 0.5), dpi=150)
+    ax.legend(handles=legend_elements + line_elements, loc='center', ncol=len(legend_elements) + len(line_elements),
+              frameon=False)
+    ax.axis('off')
+    legend_path = save_graph(fig, report_location, 'report_legend')
+
+    variables = summary_table.index.get_level_values('variable')
+    periods = summary_table.index.get_level_values('period')
+    entities = summary_table.index.get_level_values('entity')
+    reported = variables.isin(environ_var_list) & periods.isin(PERIODS)
+    reference = summary_table.loc[reported & entities.isin(DATA_GROUPS), ['Mean', '50th_percentile']]
+
+    shared_assets = {'style': os.path.basename(style_path), 'legend': os.path.basename(legend_path),
+                     'reference': reference}
+
+    # Each participant's slice of the stats and effect tables, and their downsampled series of every variable.
+    participant_stats = summary_table.loc[reported & entities.isin(participant_meta.index)]
+    participant_effects = effect_table[effect_table.index.get_level_values('entity').isin(participant_meta.index)]
+    stats_by_participant = dict(tuple(participant_stats.groupby(level='entity')))
+    effects_by_participant = dict(tuple(participant_effects.groupby(level='entity')))
+    series = {environ_var: group_participant_series(cohort_df, list(participant_meta.index), environ_var)
+              for environ_var in environ_var_list}
+
+    report_jobs = []
+    for part_id, meta in participant_meta.iterrows():
+        if part_id not in stats_by_participant:
+            continue
+        report_data = {
+            'group': meta['GroupNO'],
+            'color': meta['color'],
+            'visits': meta[['1', '2', '2B', '3', '3B', '4']],
+            'stats': stats_by_participant[part_id].droplevel('entity'),
+            'effects': effects_by_participant[part_id].droplevel('entity') if part_id in effects_by_participant else
+            None,
+            'series': {environ_var: series[environ_var][part_id] for environ_var in environ_var_list if
+                       part_id in series[environ_var]},
+        }
+        report_jobs.append((part_id, report_data))
+
+    return shared_assets, report_jobs
+
+def generate_participant_reports(report_jobs, shared_assets, report_location, workers=None):
+    """Writes the report-back document of every participant, spread over a pool of worker processes, and logs the time
+    each document took.
+
+    Args:
+        report_jobs (list) : (part_id, report_data) for every participant, from build_report_jobs.
+        shared_assets (dict) : shared assets from build_report_jobs.
+        report_location (str) : pathway to where the reports are saved.
+        workers (int) : number of worker processes, or None to write the reports in order in this process.
+
+    Returns:
+        file_paths (list) : location of each report, in job order.
+    """
+
+    start_time = datetime.now()
+
+    if workers:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(write_participant_report, part_id, report_data, shared_assets, report_location)
+                       for part_id, report_data in report_jobs]
+            results = [future.result() for future in futures]
+    else:
+        results = [write_participant_report(part_id, report_data, shared_assets, report_location)
+                   for part_id, report_data in report_jobs]
+
+    for (part_id, _), (file_path, seconds) in zip(report_jobs, results):
+        logging.info(f"Report for {part_id} saved to {file_path} in {seconds:.2f} s.")
+    logging.info(f"Wrote {len(report_jobs)} reports in {(datetime.now() - start_time).total_seconds():.1f} s.")
+
+    return [file_path for file_path, _ in results]
+
+def write_participant_report(part_id, report_data, shared_assets, report_location):
+    """Writes one participant's report-back document as an HTML page: for every variable, their mean, median, and
+    maximum in each period next to their group and all participants, the change between periods, and a graph of their
+    hourly values. The stylesheet and legend are linked from the shared assets rather than made again.
+
+    Args:
+        part_id (str) : participant ID.
+        report_data (dict) : the participant's data from build_report_jobs.
+        shared_assets (dict) : shared assets from build_report_jobs.
+        report_location (str) : pathway to where the reports are saved.
+
+    Returns:
+        file_path (str) : location of the report.
+        seconds (float) : time taken to make the report.
+    """
+
+    start_time = datetime.now()
+
+    ed_group = report_data['group']
+    reference = shared_assets['reference']
+    visits = report_data['visits']
+
+    sections = []
+    for environ_var, (times, values) in report_data['series'].items():
+        stats = report_data['stats'].loc[environ_var]
+        group_reference = reference.xs((environ_var, f'group_{ed_group}'), level=('variable', 'entity'))
+        overall_reference = reference.xs((environ_var, 'overall'), level=('variable', 'entity'))
+
+        # Participant's mean, median, and maximum in each period, next to the means and medians of the cohort.
+        comparison = pd.DataFrame({
+            'Your mean': stats['Mean'],
+            'Your median': stats['50th_percentile'],
+            'Your maximum': stats['Maximum'],
+            f'Group {ed_group} mean': group_reference['Mean'],
+            'All participants mean': overall_reference['Mean'],
+        }).reindex(PERIODS)
+        table_html = comparison.to_html(float_format='{:.1f}'.format, na_rep='-')
+
+        effects_html = ''
+        if report_data['effects'] is not None and environ_var in report_data['effects'].index:
+            effects = report_data['effects'].loc[environ_var, ['Effect']].rename(columns={'Effect': 'Change in mean'})
+            effects_html = effects.to_html(float_format='{:+.1f}'.format, na_rep='-')
+
+        graph_path = graph_participant_report(times, values, report_data['color'], visits,
+                                              group_reference['Mean'], overall_reference['Mean'], part_id, environ_var,
+                                              report_location)
+
+        sections.append(f'<h2>{environ_var}</h2>\n{table_html}\n{effects_html}\n'
+                        f'<img src="{os.path.basename(graph_path)}" alt="{environ_var} vs Time, {part_id}">')
+
+    dates = ', '.join(f'{period}: {visits[start]:%m/%d/%Y} - {visits[end]:%m/%d/%Y}' for period, (start, end) in
+                      zip(PERIODS, PERIOD_VISITS))
+    document = (f'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>Report Back {part_id}</title>\n'
+                f'<link rel="stylesheet" href="{shared_assets["style"]}">\n</head>\n<body>\n'
+                f'<h1>Report Back: {part_id} (Group {ed_group})</h1>\n<p>{dates}</p>\n'
+                f'<img src="{shared_assets["legend"]}" alt="Legend">\n' + '\n'.join(sections) +
+                '\n</body>\n</html>\n')
+
+    file_path = os.path.join(report_location, f'{part_id}_report.html')
+    with open(file_path, 'w') as report_file:
+        report_file.write(document)
+
+    return file_path, (datetime.now() - start_time).total_seconds()
+
+def graph_participant_report(times, values, color, visits, group_means, overall_means, part_id, environ_var,
+                             report_location):
+    """Graphs one participant's (downsampled) timeseries with the mean of their group and of all participants in
+    each period drawn across that period.
+
+    Args:
+        times (array) : timestamps of the series.
+        values (array) : values of the series.
+        color (tuple) : the participant's group color.
+        visits (Series) : the participant's visit dates.
+        group_means (Series) : mean of the participant's group in each period.
+        overall_means (Series) : mean of all participants in each period.
+        part_id (str) : participant ID.
+        environ_var (str) : Name of current environmental variable.
+        report_location (str) : pathway to where the reports are saved.
+
+    Returns:
+        file_path (str) : location of the saved graph.
+    """
+
+    overall_color = group_colors()['Overall']
+
+    fig, ax = plt.subplots(figsize=(8, 4), dpi=150)
+    title = f'{environ_var} vs Time, {part_id}'
+    ax.set_title(title, fontdict={'fontweight': 'bold', 'fontsize': 16})
+    ax.set_xlabel('Timestamp', fontdict={'fontweight': 'bold', 'fontsize': 12})
+    ax.set_ylabel(f'{environ_var}', fontdict={'fontweight': 'bold', 'fontsize': 12})
+
+    ax.plot(times, values, color=color, linewidth=1)
+
+    # Draw the group and overall mean across each period, on top of the hourly values.
+    for period, (start, end) in zip(PERIODS, PERIOD_VISITS):
+        ax.hlines(group_means.get(period, np.nan), visits[start], visits[end], colors=[color], linestyles='--',
+                  linewidth=2, zorder=3)
+        ax.hlines(overall_means.get(period, np.nan), visits[start], visits[end], colors=[overall_color],
+                  linestyles='--', linewidth=2, zorder=3)
+
+    ax.tick_params(axis='x', labelrotation=45)
+
+    # Save the plot to the specified directory
+    return save_graph(fig, report_location, title.replace(' ', '_').replace(',', ''))
+
+def graph_calendar_heatmap(days, daily, part_ids, stat_label, environ_var, graph_location):
+    """Graphs a daily statistic of every participant as a calendar heatmap, participants x days, drawn as a single
+    image so that it takes the same time however many days and participants there are.
+
+    Args:
+        days (DatetimeIndex) : the day of each column of daily, from calculate_daily_rollup.
+        daily (array) : (participant, day) array of the daily statistic, NaN on days without data.
+        part_ids (list) : participant IDs, in the order of the rows of daily.
+        stat_label (str) : name of the daily statistic (e.g. 'Daily Mean').
+        environ_var (str) : Name of current environmental variable.
+        graph_location (str) : pathway to where graphs are saved.
+
+    Returns:
+        file_path (str) : location of the saved graph.
+    """
+
+    fig, ax = plt.subplots(figsize=(10, 2 + 0.2 * len(part_ids)), dpi=150)
+    title = f'{environ_var} {stat_label} Calendar'
+    ax.set_title(title, fontdict={'fontweight': 'bold', 'fontsize': 18})
+    ax.set_xlabel('Date', fontdict={'fontweight': 'bold', 'fontsize': 14})
+    ax.set_ylabel('Participant', fontdict={'fontweight': 'bold', 'fontsize': 14})
+
+    # Each cell spans its whole day on a date axis; days without data are left blank.
+    if len(days):
+        extent = (mdates.date2num(days[0]), mdates.date2num(days[-1] + pd.Timedelta(days=1)), len(part_ids), 0)
+        image = ax.imshow(daily, aspect='auto', interpolation='nearest', cmap='viridis', extent=extent)
+        ax.xaxis_date()
+        fig.colorbar(image, ax=ax, label=f'{environ_var} {stat_label}')
+
+    ax.set_yticks(np.arange(len(part_ids)) + 0.5, part_ids, fontsize=6)
+    ax.tick_params(axis='x', labelrotation=45)
+
+    # Save the plot to the specified directory
+    return save_graph(fig, graph_location, title.replace(' ', '_'))
+
+# Page of the offline dashboard; write_dashboard replaces __DASHBOARD_DATA__ with the embedded JSON data.
+DASHBOARD_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>AIRE Dashboard</title>
+<style>
+body { font-family: Helvetica, Arial, sans-serif; margin: 1.5em; color: #222; }
+label { margin-right: 1.5em; }
+canvas { border: 1px solid #ccc; margin-top: 1em; display: block; }
+table { border-collapse: collapse; margin-top: 1em; }
+th, td { border: 1px solid #ccc; padding: 0.2em 0.6em; text-align: right; }
+</style>
+</head>
+<body>
+<h1>AIRE Dashboard</h1>
+<div>
+<label>Group <select id="group"></select></label>
+<label>Participant <select id="entity"></select></label>
+<label>Variable <select id="variable"></select></label>
+<label>Period <select id="period"></select></label>
+</div>
+<canvas id="series" width="1000" height="300"></canvas>
+<canvas id="profile" width="1000" height="250"></canvas>
+<table id="stats"></table>
+<script id="dashboard-data" type="application/json">__DASHBOARD_DATA__</script>
+<script>
+const data = JSON.parse(document.getElementById('dashboard-data').textContent);
+const select = id => document.getElementById(id);
+const hour = 3600 * 1000;
+
+function fill(id, options) {
+  const current = select(id).value;
+  select(id).innerHTML = options.map(o => `<option>${o}</option>`).join('');
+  if (options.includes(current)) select(id).value = current;
+}
+
+function entitiesOfGroup(group) {
+  if (group === 'All') return data.entities;
+  return data.entities.filter(e => data.groups[e] === group || e === 'group_' + group);
+}
+
+function drawAxes(ctx, canvas, lo, hi, title) {
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  ctx.fillStyle = '#222';
+  ctx.font = 'bold 14px Helvetica';
+  ctx.fillText(title, 60, 18);
+  ctx.font = '11px Helvetica';
+  for (let i = 0; i <= 4; i++) {
+    const y = 30 + (canvas.height - 60) * (1 - i / 4);
+    ctx.fillText((lo + (hi - lo) * i / 4).toFixed(1), 5, y + 4);
+    ctx.strokeStyle = '#eee';
+    ctx.beginPath(); ctx.moveTo(55, y); ctx.lineTo(canvas.width - 10, y); ctx.stroke();
+  }
+}
+
+function drawLine(ctx, xs, ys, xScale, yScale, color, width) {
+  ctx.strokeStyle = color; ctx.lineWidth = width; ctx.beginPath();
+  let drawing = false;
+  ys.forEach((y, i) => {
+    if (y === null) { drawing = false; return; }
+    if (drawing) ctx.lineTo(xScale(xs[i]), yScale(y)); else ctx.moveTo(xScale(xs[i]), yScale(y));
+    drawing = true;
+  });
+  ctx.stroke(); ctx.lineWidth = 1;
+}
+
+function range(values) {
+  const valid = values.filter(v => v !== null);
+  if (!valid.length) return [0, 1];
+  const lo = Math.min(...valid), hi = Math.max(...valid);
+  return lo === hi ? [lo - 1, hi + 1] : [lo, hi];
+}
+
+function drawSeries(entity, variable, period) {
+  const canvas = select('series'), ctx = canvas.getContext('2d');
+  const values = data.series[variable][entity];
+  const start = Date.parse(data.start);
+  const times = values.map((_, i) => start + i * data.rollup_hours * hour);
+  let t0 = times[0], t1 = times[times.length - 1];
+  const visits = data.visits[entity];
+  if (visits && period !== 'All') {
+    const [first, last] = data.period_visits[data.periods.indexOf(period) - 1];
+    t0 = Date.parse(visits[first]); t1 = Date.parse(visits[last]);
+  }
+  const shown = values.map((v, i) => times[i] >= t0 && times[i] <= t1 ? v : null);
+  const [lo, hi] = range(shown);
+  const xScale = t => 55 + (canvas.width - 65) * (t - t0) / Math.max(t1 - t0, 1);
+  const yScale = v => 30 + (canvas.height - 60) * (1 - (v - lo) / (hi - lo));
+  drawAxes(ctx, canvas, lo, hi, `${variable} vs Time, ${entity} (${data.rollup_hours}-hour means)`);
+
+  // Shade the study periods of a participant.
+  if (visits) {
+    ['rgba(161,201,244,0.25)', 'rgba(255,180,130,0.25)', 'rgba(141,229,161,0.25)'].forEach((color, i) => {
+      const [first, last] = data.period_visits[i];
+      ctx.fillStyle = color;
+      const x0 = Math.max(xScale(Date.parse(visits[first])), 55);
+      const x1 = Math.min(xScale(Date.parse(visits[last])), canvas.width - 10);
+      if (x1 > x0) ctx.fillRect(x0, 30, x1 - x0, canvas.height - 60);
+    });
+  }
+  drawLine(ctx, times, shown, xScale, yScale, '#1f4e79', 1.5);
+  ctx.fillStyle = '#222';
+  ctx.fillText(new Date(t0).toISOString().slice(0, 10), 55, canvas.height - 12);
+  ctx.fillText(new Date(t1).toISOString().slice(0, 10), canvas.width - 80, canvas.height - 12);
+}
+
+function drawProfile(entity, variable, period) {
+  const canvas = select('profile'), ctx = canvas.getContext('2d');
+  const profile = (data.profiles[variable][period] || {})[entity];
+  if (!profile) { drawAxes(ctx, canvas, 0, 1, `No ${period} profile for ${entity}`); return; }
+  const hours = [...Array(24).keys()];
+  const [lo, hi] = range(profile['25th_percentile'].concat(profile['75th_percentile'], profile['Mean']));
+  const xScale = h => 55 + (canvas.width - 65) * h / 23;
+  const yScale = v => 30 + (canvas.height - 60) * (1 - (v - lo) / (hi - lo));
+  drawAxes(ctx, canvas, lo, hi, `${variable} by Hour of Day, ${entity}, ${period} (median, mean, and IQR)`);
+
+  ctx.fillStyle = 'rgba(31,78,121,0.2)'; ctx.beginPath();
+  hours.forEach(h => ctx.lineTo(xScale(h), yScale(profile['75th_percentile'][h] ?? lo)));
+  hours.slice().reverse().forEach(h => ctx.lineTo(xScale(h), yScale(profile['25th_percentile'][h] ?? lo)));
+  ctx.fill();
+  drawLine(ctx, hours, profile['50th_percentile'], xScale, yScale, '#1f4e79', 2);
+  drawLine(ctx, hours, profile['Mean'], xScale, yScale, '#c0504d', 1);
+  ctx.fillStyle = '#222';
+  hours.filter(h => h % 3 === 0).forEach(h => ctx.fillText(h, xScale(h) - 4, canvas.height - 12));
+}
+
+function drawStats(entity, variable) {
+  const rows = data.periods.map(period => {
+    const values = data.stats[variable][period][entity];
+    return `<tr><th>${period}</th>` + values.map(v => `<td>${v === null ? '-' : v}</td>`).join('') + '</tr>';
+  });
+  select('stats').innerHTML = '<tr><th></th>' + data.stat_columns.map(c => `<th>${c}</th>`).join('') + '</tr>' +
+    rows.join('');
+}
+
+function update() {
+  fill('entity', entitiesOfGroup(select('group').value));
+  const entity = select('entity').value, variable = select('variable').value, period = select('period').value;
+  drawSeries(entity, variable, period);
+  drawProfile(entity, variable, period);
+  drawStats(entity, variable);
+}
+
+fill('group', ['All', 'A', 'B', 'C']);
+fill('variable', data.variables);
+fill('period', data.periods);
+['group', 'entity', 'variable', 'period'].forEach(id => select(id).addEventListener('change', update));
+update();
+</script>
+</body>
+</html>
+"""
+
+def build_dashboard_data(participant_meta, summary_table, profile_table, rollup_times, rollup, environ_var_list,
+                         rollup_hours):
+    """Collects the pre-aggregated data embedded in the dashboard: each participant's and combined entry's series at
+    the rollup resolution, the summary statistics, and the hour-of-day profiles (all weekdays) of every variable and
+    period. Its size depends on the number of rollup buckets, not on the number of raw samples.
+
+    Args:
+        participant_meta (df) : participant metadata indexed by 'part_id' with 'GroupNO' and visit columns.
+        summary_table (df) : summary statistics indexed by ('variable', 'period', 'entity').
+        profile_table (df) : profile statistics from calculate_diurnal_profiles.
+        rollup_times (Index) : the first hour of each rollup bucket, from bucket_aligned.
+        rollup (array) : (variable, participant, bucket) array of bucket means, from bucket_aligned.
+        environ_var_list (list) : names of the environmental variables in the dashboard.
+        rollup_hours (int) : hours per rollup bucket.
+
+    Returns:
+        dashboard_data (dict) : JSON-ready data of the dashboard.
+    """
+
+    part_ids = list(participant_meta.index)
+    entities = part_ids + DATA_GROUPS
+    stat_columns = [column for column in summary_table.columns if column != 'count']
+
+    # Series of the combined entries: the mean over their participants of each bucket.
+    group_means = group_aligned_series(rollup, participant_meta['GroupNO'], percentiles=())['mean']
+    series = {environ_var: {**{part_id: json_values(rollup[i, j]) for j, part_id in enumerate(part_ids)},
+                            **{entity: json_values(group_means[i, k]) for k, entity in enumerate(DATA_GROUPS)}}
+              for i, environ_var in enumerate(environ_var_list)}
+
+    # Summary statistics of every entity, and the hour-of-day profile (mean, median, interquartile range) of every
+    # entity over all weekdays.
+    stats = {}
+    profiles = {}
+    all_weekdays = profile_table.xs('All', level='weekday')
+    for environ_var in environ_var_list:
+        stats[environ_var] = {}
+        profiles[environ_var] = {}
+        for period in ['All'] + PERIODS:
+            period_stats = summary_table.loc[(environ_var, period)].reindex(entities)
+            stats[environ_var][period] = {entity: json_values(row) for entity, row in
+                                          zip(entities, period_stats[stat_columns].to_numpy(float))}
+
+            period_profiles = all_weekdays.loc[(environ_var, period)]
+            profiles[environ_var][period] = {
+                entity: {stat: json_values(period_profiles.loc[entity, stat].reindex(range(24)).to_numpy(float))
+                         for stat in ['Mean', '25th_percentile', '50th_percentile', '75th_percentile']}
+                for entity in entities if entity in period_profiles.index.get_level_values('entity')}
+
+    visits = participant_meta[['1', '2', '2B', '3', '3B', '4']]
+    dashboard_data = {
+        'variables': environ_var_list,
+        'periods': ['All'] + PERIODS,
+        'period_visits': PERIOD_VISITS,
+        'groups': {part_id: group for part_id, group in participant_meta['GroupNO'].items()},
+        'entities': entities,
+        'visits': {part_id: {visit: f'{date:%Y-%m-%dT%H:%M}' for visit, date in row.items()} for part_id, row in
+                   visits.iterrows()},
+        'rollup_hours': rollup_hours,
+        'start': f'{rollup_times[0]:%Y-%m-%dT%H:%M}' if len(rollup_times) else None,
+        'series': series,
+        'stat_columns': stat_columns,
+        'stats': stats,
+        'profiles': profiles,
+    }
+
+    return dashboard_data
+
+def json_values(values):
+    # Round an array of values for the dashboard, with NaN as None (null in JSON).
+    return [None if np.isnan(value) else round(float(value), 2) for value in values]
+
+def write_dashboard(dashboard_data, graph_location):
+    """Writes the dashboard as a single self-contained HTML file with its data embedded, which can be opened offline
+    to switch between groups, participants, variables, and periods without running this script again.
+
+    Args:
+        dashboard_data (dict) : data of the dashboard, from build_dashboard_data.
+        graph_location (str) : pathway to where the dashboard is saved.
+
+    Returns:
+        file_path (str) : location of the dashboard.
+    """
+
+    # Escape '</' so that the data can never close the script element it is embedded in.
+    payload = json.dumps(dashboard_data, separators=(',', ':')).replace('</', '<\\/')
+
+    file_path = os.path.join(graph_location, 'dashboard.html')
+    with open(file_path, 'w') as dashboard_file:
+        dashboard_file.write(DASHBOARD_TEMPLATE.replace('__DASHBOARD_DATA__', payload))
+
+    logging.info(f"Dashboard ({len(payload) / 1e6:.2f} MB of data) successfully saved to {file_path}.")
+
+    return file_path
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
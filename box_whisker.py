@@ -3,29 +3,24 @@ import numpy as np
 import os
 import matplotlib.pyplot as plt
 
-folder_path = "/Users/maddiewallace/PycharmProjects/AIRE_Report_Back2/outputs/"
-csv_files = [file for file in os.listdir(folder_path) if file.endswith(".csv")]
+# Summary statistics exported by airthings_graph3.py; the boxes are drawn from its percentiles, not the raw samples.
+folder_path = "/Users/maddiewallace/PycharmProjects/AIREanalysis/graph_outputs/"
+summary_table = pd.read_csv(os.path.join(folder_path, "summary_stats.csv"))
 
-pm25_data = {}
+# PM2.5 over the whole collection for each participant (and each combined entry) with data.
+pm25_stats = summary_table[(summary_table['variable'] == 'pm25') & (summary_table['period'] == 'All') &
+                           (summary_table['count'] > 0)]
 
-for file in csv_files:
-    file_path = os.path.join(folder_path, file)
-    participant_id = os.path.splitext(file)[0]
-    data = pd.read_csv(file_path)
-    data['pm25'] = pd.to_numeric(data['pm25'], errors='coerce')  # Convert 'PM2.5' column to numeric
-    pm25_data[participant_id] = data['pm25'].dropna().tolist()
-
-# Create a list of PM2.5 values for each participant
-participant_values = [pm25_data[participant] for participant in pm25_data]
-
-# Create a list of participant IDs
-participant_ids = list(pm25_data.keys())
+# Create the box statistics for each participant: box from the 25th to 75th percentile, whiskers at 10th and 90th.
+box_stats = [{'label': row['entity'], 'whislo': row['10th_percentile'], 'q1': row['25th_percentile'],
+              'med': row['50th_percentile'], 'q3': row['75th_percentile'], 'whishi': row['90th_percentile']}
+             for _, row in pm25_stats.iterrows()]
 
 # Create the box and whisker plot
-plt.figure(figsize=(10, 6))
-plt.boxplot(participant_values, labels=participant_ids, showfliers=False)
-plt.xlabel('Participant')
-plt.ylabel('PM2.5')
-plt.title('PM2.5 Box and Whisker Plot')
-plt.xticks(rotation=45)
-plt.show()
\ No newline at end of file
+fig, ax = plt.subplots(figsize=(10, 6))
+ax.bxp(box_stats, showfliers=False)
+ax.set_xlabel('Participant')
+ax.set_ylabel('PM2.5')
+ax.set_title('PM2.5 Box and Whisker Plot')
+ax.tick_params(axis='x', labelrotation=45)
+plt.show()